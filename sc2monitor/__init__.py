@@ -1,8 +1,8 @@
-"""sc2monitor keeps keeps track of large amount StarCraft 2 accounts."""
-import asyncio
-
-from sc2monitor.controller import Controller
+"""sc2monitor keeps keeps track of large amount StarCraft 2 accounts.
 
+The controller (and with it aiohttp and SQLAlchemy) is imported lazily
+on first use, so that importing the package is fast.
+"""
 db_credentials = dict(
     protocol="mysql+pymysql",
     host="localhost",
@@ -14,10 +14,17 @@ api_credentials = dict(
     key=None,
     secret=None)
 
+engine_options = dict(
+    profile=None)
+
 
 def init(host=None, user=None, passwd=None, db=None, protocol=None,
-         api_key=None, api_secret=None):
-    """Init the sc2monitor give database and api credentials."""
+         api_key=None, api_secret=None, engine_profile=None):
+    """Init the sc2monitor give database and api credentials.
+
+    The engine profile is a name of sc2monitor.model.ENGINE_PROFILES
+    (e.g. 'mysql') or a dict of options passed to create_engine.
+    """
     if host is not None:
         db_credentials['host'] = host
     if user is not None:
@@ -32,28 +39,47 @@ def init(host=None, user=None, passwd=None, db=None, protocol=None,
         api_credentials['key'] = api_key
     if api_secret is not None:
         api_credentials['secret'] = api_secret
+    if engine_profile is not None:
+        engine_options['profile'] = engine_profile
+
+
+def __getattr__(name):
+    """Import the controller lazily."""
+    if name == 'Controller':
+        from sc2monitor.controller import Controller
+        return Controller
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def add_player(url):
     """Add a player to the sc2monitor by Battl.net URL."""
+    from sc2monitor.controller import Controller
     kwargs = {}
     kwargs['db'] = '{protocol}://{user}:{passwd}@{host}/{db}'.format(
         **db_credentials)
+    kwargs['engine_profile'] = engine_options['profile']
     controller = Controller(**kwargs)
     controller.add_player(url=url)
 
 
 def remove_player(url):
     """Remove a player off the sc2monitor by Battl.net URL."""
+    from sc2monitor.controller import Controller
     kwargs = {}
     kwargs['db'] = '{protocol}://{user}:{passwd}@{host}/{db}'.format(
         **db_credentials)
+    kwargs['engine_profile'] = engine_options['profile']
     controller = Controller(**kwargs)
     controller.remove_player(url=url)
 
 
-async def main_loop():
-    """Define the asyncio main loop of the sc2monitor."""
+async def main_loop(profile=None, interval=None, budget=None):
+    """Define the asyncio main loop of the sc2monitor.
+
+    If an interval (in seconds) is given, the sc2monitor keeps running.
+    The budget limits the duration of each run (in seconds).
+    """
+    from sc2monitor.controller import Controller
     kwargs = {}
 
     if db_credentials['passwd'] is not None:
@@ -61,6 +87,7 @@ async def main_loop():
     else:
         db = '{protocol}://{user}@{host}/{db}'
     kwargs['db'] = db.format(**db_credentials)
+    kwargs['engine_profile'] = engine_options['profile']
 
     if api_credentials['key'] is not None:
         kwargs['api_key'] = api_credentials['key']
@@ -68,9 +95,20 @@ async def main_loop():
         kwargs['api_secret'] = api_credentials['secret']
 
     async with Controller(**kwargs) as ctrl:
-        await ctrl.run()
-
-
-def run():
-    """Run the sc2monitor."""
-    asyncio.run(main_loop())
+        if interval:
+            await ctrl.run_forever(interval, profile=profile,
+                                   budget=budget)
+        else:
+            await ctrl.run(profile=profile, budget=budget)
+
+
+def run(profile=None, interval=None, budget=None):
+    """Run the sc2monitor (profiled if profile is True).
+
+    If an interval (in seconds) is given, the sc2monitor runs as daemon.
+    If a budget (in seconds) is given, each run stops starting players
+    once it is spent, otherwise the config key run_budget is used.
+    """
+    import asyncio
+    asyncio.run(main_loop(profile=profile, interval=interval,
+                          budget=budget))
@@ -0,0 +1,120 @@
+"""Circuit breakers failing fast on degraded api regions and endpoints."""
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Request rejected as the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Circuit breaker of a single (region, endpoint family) pair.
+
+    The breaker opens if at least half of the last `window` requests
+    were made and `error_rate` of them failed. Requests are rejected
+    while it is open. After `cooldown` seconds it is half-open and lets a
+    single probe request through, which closes it again if successful.
+    """
+
+    def __init__(self, name, error_rate=0.5, window=20, cooldown=30.0):
+        """Init the closed breaker."""
+        self.name = name
+        self.error_rate = error_rate
+        self.window = window
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened = 0.0
+        self._probing = False
+
+    def _transition(self, state):
+        """Change and log the state."""
+        log = logger.warning if state == OPEN else logger.info
+        log(f'Circuit breaker {self.name} changed from'
+            f' {self.state} to {state}.')
+        self.state = state
+
+    def allow(self):
+        """Return if a request may be made.
+
+        If the breaker is half-open afterwards, the request is the probe.
+        """
+        if self.state == CLOSED:
+            return True
+        if (self.state == OPEN
+                and time.monotonic() - self.opened >= self.cooldown):
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, success, probe=False):
+        """Record the outcome of a request.
+
+        Only the outcome of the probe counts while the breaker is not
+        closed, requests made before it opened are ignored.
+        """
+        if probe:
+            self._probing = False
+            if success:
+                self.outcomes.clear()
+                self._transition(CLOSED)
+            else:
+                self._open()
+            return
+        if self.state != CLOSED:
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if (len(self.outcomes) * 2 >= self.window
+                and failures >= self.error_rate * len(self.outcomes)):
+            self._open()
+
+    def abandon_probe(self):
+        """Let another request probe as the probe was not made."""
+        self._probing = False
+
+    def _open(self):
+        """Open the breaker (again)."""
+        self.opened = time.monotonic()
+        if self.state != OPEN:
+            self._transition(OPEN)
+
+
+class CircuitBreakers:
+    """Circuit breakers by region and endpoint family.
+
+    An error rate of 0 disables the breakers.
+    """
+
+    def __init__(self, error_rate=0.5, window=20, cooldown=30.0):
+        """Init without any breakers."""
+        self.error_rate = error_rate
+        self.window = window
+        self.cooldown = cooldown
+        self.breakers = {}
+
+    @property
+    def enabled(self):
+        """Return if the breakers are enabled."""
+        return self.error_rate > 0.0
+
+    def get(self, region, family):
+        """Return the breaker of a region and endpoint family."""
+        key = (region, family)
+        try:
+            return self.breakers[key]
+        except KeyError:
+            breaker = CircuitBreaker(
+                f'{family}@{region}', error_rate=self.error_rate,
+                window=self.window, cooldown=self.cooldown)
+            self.breakers[key] = breaker
+            return breaker
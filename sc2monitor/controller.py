@@ -2,34 +2,73 @@
 import asyncio
 import logging
 import math
+import os
+import re
 import time
+from collections import namedtuple
 from datetime import datetime, timedelta
 from operator import itemgetter
 
-import aiohttp
+from sqlalchemy.orm import selectinload
 
 import sc2monitor.model as model
+from sc2monitor.breaker import CircuitBreakers, CircuitOpenError
 from sc2monitor.handlers import SQLAlchemyHandler
-from sc2monitor.sc2api import SC2API
+from sc2monitor.limiter import ConcurrencyLimiter
+from sc2monitor.metrics import Metrics, PeakRSS, PoolMetrics
+from sc2monitor.profiling import Profiler
+from sc2monitor.sc2api import SC2API, InvalidApiResponse
+from sc2monitor.sqlstats import SQLStatistics, current_player
+from sc2monitor.transport import RecordingTransport, ReplayTransport
 
 logger = logging.getLogger(__name__)
 sql_logger = logging.getLogger()
 
+# A player profile represented by one of its player entries.
+Profile = namedtuple('Profile', ['id', 'server', 'realm', 'player_id'])
+
 
 class Controller:
     """Control the sc2monitor."""
 
     def __init__(self, **kwargs):
         """Init the sc2monitor."""
+        self.record = kwargs.pop('record', '')
+        self.replay = kwargs.pop('replay', '')
+        self.replay_speed = kwargs.pop('replay_speed', 1.0)
+        self.sqlite_profile = kwargs.pop('sqlite_profile', None)
+        self.engine_profile = kwargs.pop('engine_profile', None)
         self.kwargs = kwargs
         self.sc2api = None
         self.db_session = None
         self.current_season = {}
+        self.season_ids = {}
+        self.rollovers = {}
+        self.crawled = {}
+        self.ladder_cache = {}
+        self.changed_players = set()
+        self.deferred_players = set()
+        self.deadline = None
+        self.run_entry = None
+        self.completed_players = set()
+        self.pending_checkpoints = 0
+        self.players_due = 0
+        self.players_processed = 0
+        self.metrics = Metrics(enabled=False)
+        self.sql_stats = SQLStatistics(enabled=False)
+        self.pool_metrics = PoolMetrics(self.metrics)
 
     async def __aenter__(self):
         """Create a aiohttp and db session that will later be closed."""
+        # Imported here as adding and removing players does not need aiohttp.
+        import aiohttp
+
+        from sc2monitor.httptrace import HTTPTraceMetrics
+
         headers = {'Accept-Encoding': 'gzip, deflate'}
-        self.http_session = aiohttp.ClientSession(headers=headers)
+        self.http_session = aiohttp.ClientSession(
+            headers=headers,
+            trace_configs=[HTTPTraceMetrics(self.metrics).trace_config()])
         self.create_db_session()
         return self
 
@@ -37,7 +76,9 @@ class Controller:
         """Create sqlalchemy database session."""
         self.db_session = model.create_db_session(
             db=self.kwargs.pop('db', ''),
-            encoding=self.kwargs.pop('encoding', ''))
+            encoding=self.kwargs.pop('encoding', ''),
+            sqlite_profile=self.sqlite_profile,
+            engine_profile=self.engine_profile)
         self.handler = SQLAlchemyHandler(self.db_session)
         self.handler.setLevel(logging.INFO)
         sql_logger.setLevel(logging.INFO)
@@ -45,7 +86,48 @@ class Controller:
 
         if len(self.kwargs) > 0:
             self.setup(**self.kwargs)
+        self.metrics.enabled = bool(int(self.get_config(
+            'collect_metrics',
+            default_value=1)))
+        self.sql_stats.enabled = bool(int(self.get_config(
+            'collect_sql_stats',
+            default_value=1)))
+        self.sql_stats.threshold = int(self.get_config(
+            'sql_n_plus_one_threshold',
+            default_value=5))
+        self.sql_top_statements = int(self.get_config(
+            'sql_top_statements',
+            default_value=10))
+        self.trace_dir = self.get_config('trace_dir', default_value='')
+        self.metrics.tracer.enabled = bool(self.trace_dir)
+        if self.metrics.tracer.enabled:
+            self.metrics.tracer.detach()
+            self.metrics.tracer.attach(self.db_session)
+        if self.sql_stats.enabled:
+            self.sql_stats.detach()
+            self.sql_stats.attach(self.db_session.get_bind())
+        self.pool_metrics.attach(self.db_session.get_bind())
         self.sc2api = SC2API(self)
+        self.sc2api.breakers = CircuitBreakers(
+            error_rate=float(self.get_config(
+                'breaker_error_rate', default_value=0.5)),
+            window=int(self.get_config(
+                'breaker_window', default_value=20)),
+            cooldown=float(self.get_config(
+                'breaker_cooldown', default_value=30)))
+        self.sc2api.limiter = ConcurrencyLimiter(
+            min_limit=int(self.get_config(
+                'concurrency_limit_min', default_value=4)),
+            max_limit=int(self.get_config(
+                'concurrency_limit_max', default_value=100)),
+            latency_factor=float(self.get_config(
+                'concurrency_latency_factor', default_value=2.0)))
+        if self.replay:
+            self.sc2api.transport = ReplayTransport(
+                self.replay, speed=self.replay_speed)
+        if self.record:
+            self.sc2api.transport = RecordingTransport(
+                self.sc2api.transport, self.record)
         self.cache_matches = self.get_config(
             'cache_matches',
             default_value=1000)
@@ -58,12 +140,47 @@ class Controller:
         self.analyze_matches = self.get_config(
             'analyze_matches',
             default_value=100)
+        self.fetch_concurrency = int(self.get_config(
+            'fetch_concurrency',
+            default_value=100))
+        self.reconcile_concurrency = int(self.get_config(
+            'reconcile_concurrency',
+            default_value=20))
+        self.persist_concurrency = int(self.get_config(
+            'persist_concurrency',
+            default_value=1))
+        self.pipeline_queue_size = int(self.get_config(
+            'pipeline_queue_size',
+            default_value=50))
+        self.player_chunk_size = int(self.get_config(
+            'player_chunk_size',
+            default_value=500))
+        self.season_margin = timedelta(hours=float(self.get_config(
+            'season_margin',
+            default_value=24)))
+        self.crawl_mode = bool(int(self.get_config(
+            'crawl_mode',
+            default_value=0)))
+        self.ladder_cache_ttl = timedelta(hours=float(self.get_config(
+            'ladder_cache_ttl',
+            default_value=24)))
 
     async def __aexit__(self, exc_type, exc, tb):
         """Close all aiohtto and database session."""
+        await self.sc2api.close()
         await self.http_session.close()
         self.db_session.commit()
+        self.close_db_session()
+
+    def close_db_session(self):
+        """Close the database session and its connections."""
+        self.sql_stats.detach()
+        self.pool_metrics.detach()
+        self.metrics.tracer.detach()
+        sql_logger.removeHandler(self.handler)
+        engine = self.db_session.get_bind()
         self.db_session.close()
+        engine.dispose()
         self.db_session = None
 
     def get_config(self, key, default_value=None,
@@ -102,9 +219,24 @@ class Controller:
     def setup(self, **kwargs):
         """Set up the sc2monitor with api-key and api-secret."""
         valid_keys = ['api_key', 'api_secret',
-                      'cache_matches', 'analyze_matches']
+                      'cache_matches', 'analyze_matches',
+                      'collect_metrics', 'collect_sql_stats',
+                      'sql_n_plus_one_threshold', 'sql_top_statements',
+                      'profile', 'profile_top', 'trace_dir',
+                      'season_margin', 'breaker_error_rate',
+                      'breaker_window', 'breaker_cooldown',
+                      'run_budget', 'fetch_concurrency',
+                      'reconcile_concurrency', 'persist_concurrency',
+                      'pipeline_queue_size', 'player_chunk_size',
+                      'resume_window', 'crawl_mode',
+                      'concurrency_limit_min', 'concurrency_limit_max',
+                      'concurrency_latency_factor', 'api_rate_limit',
+                      'ladder_cache_ttl']
         for key, value in kwargs.items():
-            if key not in valid_keys:
+            # Additional api credentials are numbered, e.g. api_key_2.
+            credential_key = re.sub(r'_([2-9]|[1-9]\d+)$', '', key)
+            if (credential_key not in ('api_key', 'api_secret')
+                    and key not in valid_keys):
                 raise ValueError(
                     f"Invalid configuration key '{key}'"
                     f" (valid keys: {', '.join(valid_keys)})")
@@ -134,8 +266,7 @@ class Controller:
             self.db_session.commit()
 
         if close_db:
-            self.db_session.close()
-            self.db_session = None
+            self.close_db_session()
 
     def remove_player(self, url):
         """Remove a player by url to the sc2monitor."""
@@ -154,22 +285,30 @@ class Controller:
         self.db_session.commit()
 
         if close_db:
-            self.db_session.close()
-            self.db_session = None
+            self.close_db_session()
 
-    async def update_season(self, server: model.Server):
-        """Update info about the current season in the database."""
-        current_season = await self.sc2api.get_season(server)
+    async def update_season(self, server: model.Server, force=False):
+        """Update info about the current season in the database.
+
+        The stored season is used without an api request unless its end
+        is less than season_margin away or force is True.
+        """
         season = self.db_session.query(model.Season).\
             filter(model.Season.server == server).\
             order_by(model.Season.season_id.desc()).\
             limit(1).scalar()
+        if (not force and season is not None
+                and datetime.now() < season.end - self.season_margin):
+            return season
 
+        current_season = await self.sc2api.get_season(server)
         if not season or current_season.season_id != season.season_id:
             self.db_session.add(current_season)
             self.db_session.commit()
             self.db_session.refresh(current_season)
             logger.info(f'Found a new ladder season: {current_season}')
+            if season is not None:
+                self.rollovers[server] = season
             return current_season
         else:
             season.start = current_season.start
@@ -179,7 +318,7 @@ class Controller:
             self.db_session.commit()
             return season
 
-    async def update_seasons(self):
+    async def update_seasons(self, force=False):
         """Update seasons info for all servers."""
         servers = [server[0] for server in self.db_session.query(
             model.Player.server).distinct()]
@@ -187,12 +326,14 @@ class Controller:
         tasks = []
 
         for server in servers:
-            tasks.append(asyncio.create_task(self.update_season(server)))
+            tasks.append(asyncio.create_task(
+                self.update_season(server, force=force)))
 
         for season in await asyncio.gather(*tasks, return_exceptions=True):
             try:
                 if isinstance(season, model.Season):
                     self.current_season[season.server.id()] = season
+                    self.season_ids[season.server.id()] = season.season_id
                 else:
                     raise season
             except Exception:
@@ -200,32 +341,338 @@ class Controller:
                     ('The following exception was'
                      ' raised while updating seasons:'))
 
-    async def query_player(self, player: model.Player):
-        """Collect api data of a player."""
-        complete_data = []
-        for ladder in await self.sc2api.get_ladders(player):
-            async for data in self.sc2api.get_ladder_data(player, ladder):
-                current_player = await self.get_player_with_race(player, data)
-                missing_games, new = self.count_missing_games(
+    async def rollover_seasons(self):
+        """Finalize the previous season of the servers with a new season.
+
+        Every previous season ladder of the tracked players is requested
+        once via the legacy api, the games played after the last update
+        of its members are guessed and their wins and losses finalized.
+        """
+        rollovers, self.rollovers = self.rollovers, {}
+        for server, season in rollovers.items():
+            players = self.db_session.query(model.Player).filter(
+                model.Player.server == server,
+                model.Player.last_active_season == season.season_id,
+                model.Player.ladder_id != 0).all()
+            ladders = {}
+            for player in players:
+                ladders.setdefault(player.ladder_id, []).append(player)
+            logger.info(f'Finalizing {len(players)} players in'
+                        f' {len(ladders)} ladders of season'
+                        f' {season.season_id} on {server}.')
+            end = min(season.end, datetime.now())
+            for ladder_id, ladder_players in ladders.items():
+                try:
+                    with self.metrics.phase('get_legacy_ladder'):
+                        members = await self.sc2api.get_legacy_ladder(
+                            server, ladder_id)
+                except Exception:
+                    logger.exception(
+                        f'The following exception was raised while'
+                        f' finalizing ladder {ladder_id}:')
+                    continue
+                for player in ladder_players:
+                    data = self.find_ladder_member(player, members)
+                    if data is not None:
+                        self.finalize_player(player, data, end)
+
+    @classmethod
+    def find_ladder_member(cls, player: model.Player, members):
+        """Return the ladder data of a player from the ladder members."""
+        candidates = members.get((player.realm, player.player_id), [])
+        for data in candidates:
+            if data['race'] == player.race:
+                return data
+        if len(candidates) == 1:
+            return candidates[0]
+        logger.info(f'{player.id}: Not found in previous season'
+                    f' ladder {player.ladder_id}.')
+        return None
+
+    def finalize_player(self, player: model.Player, data, end):
+        """Store the games of a player missed until the season end."""
+        missing = {'Win': data['wins'] - player.wins,
+                   'Loss': data['losses'] - player.losses}
+        if missing['Win'] < 0 or missing['Loss'] < 0:
+            logger.info(f'{player.id}: Previous season ladder'
+                        f' {player.ladder_id} was reset.')
+            return
+        missing['Total'] = missing['Win'] + missing['Loss']
+        if missing['Total'] == 0:
+            return
+        complete_data = {'player': player,
+                         'new_data': {'mmr': player.mmr},
+                         'missing': missing,
+                         'Win': 0,
+                         'Loss': 0}
+        self.guess_games(complete_data, end)
+        self.guess_mmr_changes(complete_data)
+        self.delete_old_matches(player)
+        player.wins = data['wins']
+        player.losses = data['losses']
+        self.db_session.commit()
+        self.calc_statistics(player)
+        self.changed_players.add(player.id)
+
+    async def crawl_ladders(self):
+        """Pull the ladders of the tracked master and grandmaster players.
+
+        The grandmaster ladder of a region and every master ladder are
+        requested once. Profiles whose players of the current season are
+        all found in these ladders are not requested individually by
+        fetch_player, their match history is only requested if games are
+        missing. Servers without a current season are not crawled.
+        """
+        self.crawled = {}
+        profiles = {}
+        unknown = set()
+        for row in self.db_session.query(
+                model.Player.server, model.Player.realm,
+                model.Player.player_id, model.Player.race,
+                model.Player.league, model.Player.ladder_id,
+                model.Player.last_active_season):
+            if row.server.id() not in self.season_ids:
+                unknown.add(row.server)
+                continue
+            profiles.setdefault(row[:3], []).append(row)
+        for server in unknown:
+            logger.warning(f'Ladders of {server.describe()} were not'
+                           ' crawled as its season is unknown.')
+
+        sources = {}
+        for key, rows in profiles.items():
+            for row in rows:
+                if row.league == model.League.Grandmaster:
+                    sources.setdefault((row.server, None), key)
+                elif row.league == model.League.Master and row.ladder_id:
+                    sources.setdefault((row.server, row.ladder_id), key)
+
+        semaphore = asyncio.Semaphore(max(self.fetch_concurrency, 1))
+
+        async def pull(source, key):
+            server, ladder_id = source
+            async with semaphore:
+                if ladder_id is None:
+                    return await self.sc2api.get_grandmaster_ladder(server)
+                return await self.sc2api.get_ladder_members(
+                    server, key[1], key[2], ladder_id)
+
+        ladders = {}
+        results = await asyncio.gather(
+            *(pull(source, key) for source, key in sources.items()),
+            return_exceptions=True)
+        for source, result in zip(sources, results):
+            if isinstance(result, Exception):
+                logger.warning(f'Ladder {source} could not be'
+                               f' crawled: {result!r}')
+            else:
+                ladders[source] = result
+
+        for key, rows in profiles.items():
+            ladder_data = []
+            for row in rows:
+                data = self.find_crawled_player(row, ladders)
+                if data is None:
+                    break
+                ladder_data.append(data)
+            else:
+                self.crawled[key] = ladder_data
+        logger.info(f'Crawled {len(self.crawled)} of {len(profiles)}'
+                    f' profiles from {len(ladders)} ladders.')
+
+    def find_crawled_player(self, row, ladders):
+        """Return the crawled ladder data of a player entry or None."""
+        season_id = self.season_ids.get(row.server.id())
+        if (not row.ladder_id or season_id is None
+                or row.last_active_season != season_id):
+            return None
+        if row.league == model.League.Grandmaster:
+            members = ladders.get((row.server, None), {})
+        else:
+            members = ladders.get((row.server, row.ladder_id), {})
+        for data in members.get((row.realm, row.player_id), []):
+            if data['race'] == row.race:
+                if data['ladder_id'] is None:
+                    data = dict(data, ladder_id=row.ladder_id)
+                return data
+        return None
+
+    async def fetch_player(self, item):
+        """Fetch the 1v1 ladder data of a player (fetch stage).
+
+        The ladder data of crawled players is taken from crawl_ladders.
+        The ladders of a profile are requested only if they are not
+        cached or the cached ladders are inconsistent with the api or
+        show fewer games than stored.
+        """
+        player = item['player']
+        key = (player.server, player.realm, player.player_id)
+        ladder_data = self.crawled.pop(key, None)
+        crawled = ladder_data is not None
+        ladders = None
+        if not crawled:
+            cached = self.cached_ladders(player)
+            if cached is not None:
+                try:
+                    ladder_data = await self.fetch_ladder_data(
+                        player, cached)
+                    if self.is_behind(player, ladder_data):
+                        # The player may have joined another ladder.
+                        raise InvalidApiResponse('fewer games than stored')
+                except InvalidApiResponse as error:
+                    ladder_data = None
+                    logger.info(f'{player.id}: Cached ladders are'
+                                f' inconsistent ({error}).')
+            if ladder_data is None:
+                with self.metrics.phase('get_ladders'):
+                    ladders = await self.sc2api.get_ladders(player)
+                ladder_data = await self.fetch_ladder_data(
+                    player, ladders, strict=False)
+        item.update({'ladder_data': ladder_data,
+                     'complete_data': [],
+                     'new': False,
+                     'name': '',
+                     'crawled': crawled,
+                     'ladders': ladders})
+
+    def is_behind(self, player: model.Player, ladder_data):
+        """Return if the ladder data has fewer games than stored."""
+        stored = {row.race: row for row in self.db_session.query(
+            model.Player.race, model.Player.wins,
+            model.Player.losses).filter(
+            model.Player.player_id == player.player_id,
+            model.Player.realm == player.realm,
+            model.Player.server == player.server)}
+        for data in ladder_data:
+            row = stored.get(data['race'])
+            if row is not None and (data['wins'] < (row.wins or 0)
+                                    or data['losses'] < (row.losses or 0)):
+                return True
+        return False
+
+    async def fetch_ladder_data(self, player: model.Player, ladders,
+                                strict=True):
+        """Fetch the data of a player in ladders.
+
+        If strict, raise InvalidApiResponse if the player is missing in
+        one of the ladders.
+        """
+        ladder_data = []
+        for ladder in ladders:
+            with self.metrics.phase('get_ladder_data'):
+                data = [data async for data in
+                        self.sc2api.get_ladder_data(player, ladder)]
+            if strict and not data:
+                raise InvalidApiResponse(f'{player.id} not in {ladder}')
+            ladder_data.extend(data)
+        return ladder_data
+
+    def load_ladder_cache(self, profiles):
+        """Load the cached ladders of the profiles."""
+        if self.ladder_cache_ttl <= timedelta(0):
+            return
+        keys = {profile[1:] for profile in profiles}
+        for entry in self.db_session.query(model.LadderMembership).filter(
+                model.LadderMembership.player_id.in_(
+                    {profile.player_id for profile in profiles})):
+            key = (entry.server, entry.realm, entry.player_id)
+            if key in keys:
+                self.ladder_cache[key] = entry
+
+    def cached_ladders(self, player: model.Player):
+        """Return the cached ladders of a profile if they are current.
+
+        Return None if there are none or they are from a previous season
+        or older than ladder_cache_ttl.
+        """
+        entry = self.ladder_cache.pop(
+            (player.server, player.realm, player.player_id), None)
+        if (entry is None
+                or entry.season_id != self.season_ids.get(player.server.id())
+                or entry.updated is None
+                or entry.updated < datetime.now() - self.ladder_cache_ttl):
+            return None
+        return entry.ladders
+
+    def store_ladders(self, item):
+        """Cache the requested ladders of a profile."""
+        player = item['player']
+        ladders = item['ladders']
+        if self.ladder_cache_ttl <= timedelta(0):
+            return
+        if ladders is None:
+            return
+        entry = self.db_session.query(model.LadderMembership).filter(
+            model.LadderMembership.player_id == player.player_id,
+            model.LadderMembership.realm == player.realm,
+            model.LadderMembership.server == player.server).scalar()
+        if not ladders:
+            # Placements of unranked profiles are not missed.
+            if entry is not None:
+                self.db_session.delete(entry)
+                self.db_session.commit()
+            return
+        if entry is None:
+            entry = model.LadderMembership(player_id=player.player_id,
+                                           realm=player.realm,
+                                           server=player.server)
+            self.db_session.add(entry)
+        entry.ladder_ids = ','.join(
+            str(ladder) for ladder in sorted(ladders, key=int))
+        entry.season_id = self.get_season_id(player.server)
+        entry.updated = datetime.now()
+        self.db_session.commit()
+
+    async def reconcile_player(self, item):
+        """Match the ladder data with the database (reconcile stage).
+
+        The match history is fetched if games are missing, the metadata
+        if the name of the player has to be refreshed.
+        """
+        player = item['player']
+        for data in item['ladder_data']:
+            current_player = await self.get_player_with_race(player, data)
+            with self.metrics.phase('count_missing_games'):
+                missing_games, item['new'] = self.count_missing_games(
                     current_player, data)
-                if missing_games['Total'] > 0:
-                    complete_data.append({'player': current_player,
-                                          'new_data': data,
-                                          'missing': missing_games,
-                                          'Win': 0,
-                                          'Loss': 0})
-
-        if len(complete_data) > 0:
-            await self.process_player(complete_data, new)
+            if missing_games['Total'] > 0:
+                item['complete_data'].append({'player': current_player,
+                                              'new_data': data,
+                                              'missing': missing_games,
+                                              'Win': 0,
+                                              'Loss': 0})
+
+        if len(item['complete_data']) > 0:
+            with self.metrics.phase('check_match_history'):
+                item['history'] = await self.check_match_history(
+                    item['complete_data'])
+        elif item['crawled']:
+            # The crawled ladder data contains the current name.
+            name = item['ladder_data'][0]['name']
+            if name and name != player.name:
+                item['name'] = name
         elif (not player.name
                 or not isinstance(player.refreshed, datetime)
                 or player.refreshed <= datetime.now() - timedelta(days=1)):
-            await self.update_player_name(player)
+            with self.metrics.phase('get_metadata'):
+                metadata = await self.sc2api.get_metadata(player)
+            item['name'] = metadata['name']
+
+    async def persist_player(self, item):
+        """Guess the missing games and store the data (persist stage)."""
+        self.store_ladders(item)
+        if len(item['complete_data']) > 0:
+            with self.metrics.phase('process_player'):
+                await self.process_player(item['complete_data'], item['new'],
+                                          history=item['history'])
+        elif item['name']:
+            await self.update_player_name(item['player'], item['name'])
 
     async def update_player_name(self, player: model.Player, name=''):
         """Update the name of a player from api data."""
         if not name:
-            metadata = await self.sc2api.get_metadata(player)
+            with self.metrics.phase('get_metadata'):
+                metadata = await self.sc2api.get_metadata(player)
             name = metadata['name']
         for tmp_player in self.db_session.query(model.Player).filter(
                 model.Player.player_id == player.player_id,
@@ -234,6 +681,7 @@ class Controller:
                 model.Player.name != name).all():
             logger.info(f"{tmp_player.id}: Updating name to '{name}'")
             tmp_player.name = name
+            self.changed_players.add(tmp_player.id)
         self.db_session.commit()
 
     async def check_match_history(self, complete_data):
@@ -280,10 +728,15 @@ class Controller:
 
         return last_played, len(match_history)
 
-    async def process_player(self, complete_data, new=False):
-        """Process the api data of a player."""
-        last_played, len_history \
-            = await self.check_match_history(complete_data)
+    async def process_player(self, complete_data, new=False, history=None):
+        """Process the api data of a player.
+
+        The match history is checked unless its result is passed.
+        """
+        if history is None:
+            with self.metrics.phase('check_match_history'):
+                history = await self.check_match_history(complete_data)
+        last_played, len_history = history
 
         for race_player in complete_data:
             race_player['missing']['Total'] = race_player['missing']['Win'] + \
@@ -296,10 +749,18 @@ class Controller:
                         f" match history ({len_history}) "
                         "of new player.")
                 else:
-                    self.guess_games(race_player, last_played)
-            self.guess_mmr_changes(race_player)
-            await self.update_player(race_player)
-            self.calc_statistics(race_player['player'])
+                    with self.metrics.phase('guess_games'):
+                        self.guess_games(race_player, last_played)
+            with self.metrics.phase('guess_mmr_changes'):
+                self.guess_mmr_changes(race_player)
+            if race_player['Win'] + race_player['Loss'] > 0:
+                with self.metrics.phase('delete_old_matches'):
+                    self.delete_old_matches(race_player['player'])
+            with self.metrics.phase('update_player'):
+                await self.update_player(race_player)
+            with self.metrics.phase('calc_statistics'):
+                self.calc_statistics(race_player['player'])
+            self.changed_players.add(race_player['player'].id)
 
     async def update_player(self, complete_data):
         """Update database with new data of a player."""
@@ -525,6 +986,13 @@ class Controller:
             filter(model.Match.player_id
                    == complete_data['player'].id).\
             order_by(model.Match.datetime.desc()).limit(1).scalar()
+        if previous_match:
+            ema_mmr = previous_match.ema_mmr or 0.0
+            emvar_mmr = previous_match.emvar_mmr or 0.0
+        else:
+            ema_mmr = 0.0
+            emvar_mmr = 0.0
+        new_matches = []
 
         # Warning breaks Travis CI
         # if not previous_match:
@@ -545,17 +1013,17 @@ class Controller:
             # should be accurate (but not mmr change).
             guess = not (idx + 1 == len(complete_data['games']))
             alpha = 2.0 / (100.0 + 1.0)
-            if previous_match and previous_match.ema_mmr > 0.0:
-                delta = MMR - previous_match.ema_mmr
-                ema_mmr = previous_match.ema_mmr + alpha * delta
+            if ema_mmr > 0.0:
+                delta = MMR - ema_mmr
                 emvar_mmr = (1.0 - alpha) * \
-                    (previous_match.emvar_mmr + alpha * delta * delta)
+                    (emvar_mmr + alpha * delta * delta)
+                ema_mmr = ema_mmr + alpha * delta
             else:
                 ema_mmr = MMR
                 emvar_mmr = 0.0
 
-            new_match = model.Match(
-                player=complete_data['player'],
+            new_matches.append(dict(
+                player_id=complete_data['player'].id,
                 result=match['result'],
                 datetime=match['datetime'],
                 mmr=MMR,
@@ -563,34 +1031,55 @@ class Controller:
                 guess=guess,
                 ema_mmr=ema_mmr,
                 emvar_mmr=emvar_mmr,
-                max_length=max_length)
+                max_length=max_length))
             complete_data['player'].last_played = match['datetime']
-            self.db_session.add(new_match)
-            previous_match = new_match
 
+        self.insert_matches(new_matches)
         self.db_session.commit()
 
-        # Delete old matches:
+    def insert_matches(self, matches):
+        """Insert matches in bulk, skipping those already stored.
+
+        Matches are identified by player, datetime and result, so that
+        retried or overlapping runs don't store them twice.
+        """
+        if not matches:
+            return
+        statement = model.insert_ignore(
+            model.Match.__table__,
+            self.db_session.get_bind().dialect.name)
+        self.db_session.execute(statement, matches)
+
+    def delete_old_matches(self, player: model.Player):
+        """Delete the matches of a player exceeding the cache."""
         deletions = 0
-        for match in self.db_session.query(model.Match).\
-                filter(model.Match.player_id == complete_data['player'].id).\
-                order_by(model.Match.datetime.desc()).\
-                offset(self.cache_matches).all():
+        for match in self.stream(self.db_session.query(model.Match).
+                                 filter(model.Match.player_id == player.id).
+                                 order_by(model.Match.datetime.desc()).
+                                 offset(self.cache_matches)):
             self.db_session.delete(match)
             deletions += 1
         if deletions > 0:
             self.db_session.commit()
-            logger.info(f"{complete_data['player'].id}: "
+            logger.info(f"{player.id}: "
                         f"{deletions} matches deleted!")
 
+    def stream(self, query):
+        """Iterate the results of a large scan with a server-side cursor.
+
+        No statements may be executed on the session (e.g. by lazy loads
+        or autoflush) until the iteration is finished.
+        """
+        return query.yield_per(1000)
+
     def update_ema_mmr(self, player: model.Player):
         """Update the exponential moving avarage MMR of a player."""
         matches = self.db_session.query(model.Match).\
             filter(model.Match.player == player).\
-            order_by(model.Match.datetime.asc()).all()
+            order_by(model.Match.datetime.asc())
 
         previous_match = None
-        for match in matches:
+        for match in self.stream(matches):
             alpha = 2.0 / (100.0 + 1.0)
             if previous_match and previous_match.ema_mmr > 0.0:
                 delta = match.mmr - previous_match.ema_mmr
@@ -608,7 +1097,7 @@ class Controller:
 
     def get_season_id(self, server: model.Server):
         """Get the current season id on a server."""
-        return self.current_season[server.id()].season_id
+        return self.season_ids[server.id()]
 
     def count_missing_games(self, player: model.Player, data):
         """Count games of the api data that are not yet in the database."""
@@ -618,12 +1107,8 @@ class Controller:
         if player.last_active_season == 0 or player.mmr == 0:
             new = True
         elif (player.last_active_season < self.get_season_id(player.server)):
-            # New Season!
-            # TODO: Check if last season endpoint can be requested!
-            # Only the legacy endpoints give the option to query the
-            # previous season's data (given that the ladder ID is
-            # known), e.g.:
-            # https://eu.api.blizzard.com/sc2/legacy/ladder/2/209966
+            # New Season! The games of the previous season are finalized
+            # by rollover_seasons.
             new = False
         elif (player.ladder_id != data['ladder_id']
                 or not player.ladder_joined
@@ -654,6 +1139,7 @@ class Controller:
                     player.ladder_id = data['ladder_id']
                     player.league = data['league']
                     self.db_session.commit()
+                    self.changed_players.add(player.id)
                     logger.info(f"{player.id}: GM promotion/demotion.")
                 else:
                     if data['league'] < player.league:
@@ -701,12 +1187,91 @@ class Controller:
 
         return correct_player
 
+    def update_leaderboard(self, full=False):
+        """Refresh the leaderboard entries of changed players and ranks.
+
+        The ranks are recomputed even if no player changed, e.g. to close
+        the gaps left by removed players.
+        """
+        if not full and self.db_session.query(
+                model.Leaderboard.id).limit(1).scalar() is None:
+            full = True
+
+        resident = {entry for entry in self.db_session.identity_map.values()
+                    if isinstance(entry, model.Player)}
+        for players in self.iter_leaderboard_players(full):
+            for player in players:
+                entry = player.leaderboard
+                if entry is None:
+                    entry = model.Leaderboard(player=player)
+                    self.db_session.add(entry)
+                stats = player.statistics
+                games = player.wins + player.losses
+                entry.name = player.name
+                entry.server = player.server
+                entry.race = player.race
+                entry.league = player.league
+                entry.mmr = player.mmr
+                entry.wins = player.wins
+                entry.losses = player.losses
+                entry.winrate = player.wins / games if games > 0 else 0.0
+                entry.trend = stats.lr_mmr_slope if stats else 0.0
+                entry.last_played = player.last_played
+            self.db_session.flush()
+            for player in players:
+                if player not in resident:
+                    self.release({'player': player})
+
+        # Ranks only depend on the leaderboard table itself, hence they are
+        # recomputed without joining the player and statistics tables.
+        # Only ranks that have actually changed result in an UPDATE.
+        server_ranks = {}
+        race_ranks = {}
+        for rank, entry in enumerate(self.stream(self.db_session.query(
+                model.Leaderboard).order_by(
+                model.Leaderboard.mmr.desc(),
+                model.Leaderboard.id.asc())), start=1):
+            server_ranks[entry.server] = server_ranks.get(entry.server, 0) + 1
+            race_ranks[entry.race] = race_ranks.get(entry.race, 0) + 1
+            if entry.rank != rank:
+                entry.rank = rank
+            if entry.server_rank != server_ranks[entry.server]:
+                entry.server_rank = server_ranks[entry.server]
+            if entry.race_rank != race_ranks[entry.race]:
+                entry.race_rank = race_ranks[entry.race]
+        self.db_session.commit()
+        self.changed_players.clear()
+
+    def iter_leaderboard_players(self, full=False):
+        """Iterate the ranked players to refresh in chunks.
+
+        The chunks hold player_chunk_size players with their leaderboard
+        entries and statistics loaded.
+        """
+        query = self.db_session.query(model.Player).options(
+            selectinload(model.Player.leaderboard),
+            selectinload(model.Player.statistics)).filter(
+            model.Player.mmr > 0).order_by(model.Player.id)
+        if full:
+            last_id = 0
+            while True:
+                players = query.filter(model.Player.id > last_id).limit(
+                    self.player_chunk_size).all()
+                if not players:
+                    return
+                yield players
+                last_id = players[-1].id
+        changed = sorted(self.changed_players)
+        for start in range(0, len(changed), self.player_chunk_size):
+            yield query.filter(model.Player.id.in_(
+                changed[start:start + self.player_chunk_size])).all()
+
     def delete_old_logs_and_runs(self):
         """ Delete old logs and runs from database."""
         deletions = 0
-        for log_entry in self.db_session.query(model.Log).\
-                order_by(model.Log.datetime.desc()).\
-                offset(self.cache_logs).all():
+        for log_entry in self.stream(self.db_session.query(model.Log).
+                                     order_by(model.Log.datetime.desc()).
+                                     offset(self.cache_logs)):
             self.db_session.delete(log_entry)
             deletions += 1
         if deletions > 0:
@@ -722,43 +1287,378 @@ class Controller:
             self.db_session.commit()
             logger.info(f"{deletions} old run logs were deleted!")
 
-    async def run(self):
-        """Run the sc2monitor."""
+    def start_run(self):
+        """Start a new run or resume an unfinished one.
+
+        An unfinished run is resumed if it started less than resume_window
+        seconds ago, the players completed by it are skipped.
+        """
+        window = float(self.get_config('resume_window', default_value=3600))
+        run = None
+        if window > 0:
+            run = self.db_session.query(model.Run).filter(
+                model.Run.finished.is_(False),
+                model.Run.datetime >= datetime.now()
+                - timedelta(seconds=window)).order_by(
+                model.Run.id.desc()).limit(1).scalar()
+        if run is None:
+            run = model.Run(finished=False)
+            self.db_session.add(run)
+            self.db_session.commit()
+            self.completed_players = set()
+        else:
+            self.completed_players = set(self.db_session.query(
+                model.RunCheckpoint.server, model.RunCheckpoint.realm,
+                model.RunCheckpoint.player_id).filter(
+                model.RunCheckpoint.run_id == run.id))
+            logger.info(f'Resuming run {run.id} skipping'
+                        f' {len(self.completed_players)} completed players.')
+        self.run_entry = run
+        self.pending_checkpoints = 0
+        return run
+
+    def checkpoint(self, player: model.Player):
+        """Record that the current run completed a player.
+
+        The checkpoint is committed along with the data of the following
+        players, but at the latest after player_chunk_size checkpoints.
+        """
+        self.db_session.add(model.RunCheckpoint(
+            run_id=self.run_entry.id, player_id=player.player_id,
+            realm=player.realm, server=player.server))
+        self.pending_checkpoints += 1
+        if self.pending_checkpoints >= self.player_chunk_size:
+            self.db_session.commit()
+            self.pending_checkpoints = 0
+
+    async def run(self, profile=None, budget=None):
+        """Run the sc2monitor.
+
+        If profile is None, profiling is enabled by the config key profile.
+        If budget is None, the time budget in seconds is read from the
+        config key run_budget (0 for none).
+        """
         start_time = time.time()
+        counters = self.run_counters()
         logger.debug("Starting job...")
+        run = self.start_run()
+        if budget is None:
+            budget = float(self.get_config('run_budget', default_value=0))
+        self.deadline = time.monotonic() + budget if budget > 0 else None
+        self.players_due = 0
+        self.players_processed = 0
+        self.changed_players.clear()
+        self.deferred_players.clear()
+        self.metrics.reset()
+        self.metrics.tracer.reset()
+        self.sql_stats.reset()
+
+        if profile is None:
+            profile = bool(int(self.get_config('profile', default_value=0)))
+        profiler = None
+        if profile:
+            profiler = Profiler(self.metrics, top=int(self.get_config(
+                'profile_top', default_value=20)))
+            profiler.start()
+        rss = PeakRSS()
+        rss.start()
 
-        await self.update_seasons()
+        try:
+            await self.run_steps()
+        finally:
+            run.peak_rss = rss.stop()
+            if profiler is not None:
+                profiler.stop()
 
-        unique_group = (model.Player.player_id,
-                        model.Player.realm, model.Player.server)
-        tasks = []
-        players = self.db_session.query(model.Player).distinct(
-            *unique_group).group_by(*unique_group).all()
+        duration = time.time() - start_time
+        run.duration = duration
+        (run.api_requests, run.api_retries, run.coalesced_requests,
+         run.warnings, run.errors) = [
+            current - start for current, start
+            in zip(self.run_counters(), counters)]
+        if self.sc2api.limiter.enabled:
+            run.concurrency_limit = self.sc2api.limiter.current
+        run.sql_statements = self.sql_stats.count
+        run.sql_time = self.sql_stats.total
+        run.deferred_players = len(self.deferred_players)
+        run.players_due = self.players_due
+        run.players_processed = self.players_processed
+        run.metrics = self.metrics.to_models()
+        run.statements = self.sql_stats.to_models(self.sql_top_statements)
+        run.profile = profiler.to_models() if profiler is not None else []
+        run.finished = True
+        self.db_session.query(model.RunCheckpoint).filter(
+            model.RunCheckpoint.run_id == run.id).delete()
+        self.db_session.commit()
+        self.run_entry = None
 
-        for player in players:
-            tasks.append(asyncio.create_task(self.query_player(player)))
+        if self.metrics.tracer.enabled:
+            path = os.path.join(self.trace_dir, f'run-{run.id}.trace.json')
+            try:
+                self.metrics.tracer.export(path)
+            except OSError:
+                logger.exception(f'Unable to write trace file {path}:')
+            self.metrics.tracer.reset()
+
+        logger.debug(f"Finished job performing {run.api_requests}"
+                     f" api requests ({run.api_retries} retries)"
+                     f" in {duration:.2f} seconds.")
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for key, result in enumerate(results):
+    def run_counters(self):
+        """Return the cumulative counters of which each run stores its part.
+
+        These are the api requests, retries and coalesced requests and the
+        logged warnings and errors.
+        """
+        return (self.sc2api.request_count, self.sc2api.retry_count,
+                self.sc2api.coalesced_count, self.handler.warnings,
+                self.handler.errors)
+
+    async def run_forever(self, interval, profile=None, budget=None):
+        """Run the sc2monitor every interval seconds (daemon mode).
+
+        The access token is refreshed in the background meanwhile.
+        """
+        self.sc2api.start_token_refresh()
+        while True:
+            started = time.monotonic()
             try:
-                if result is not None:
-                    raise result
+                await self.run(profile=profile, budget=budget)
+            except asyncio.CancelledError:
+                raise
             except Exception:
-                logger.exception(
-                    'The following exception was'
-                    f' raised while quering player {players[key].id}:')
+                self.db_session.rollback()
+                logger.exception('The following exception was'
+                                 ' raised during the run:')
+            await asyncio.sleep(
+                max(0.0, interval - (time.monotonic() - started)))
+
+    def iter_profiles(self):
+        """Iterate the columns needed to prioritize all players.
+
+        The players are read in keyset-paginated chunks of
+        player_chunk_size rows.
+        """
+        last_id = 0
+        while True:
+            rows = self.db_session.query(
+                model.Player.id, model.Player.server, model.Player.realm,
+                model.Player.player_id, model.Player.last_played,
+                model.Player.last_active_season, model.Player.league).filter(
+                model.Player.id > last_id).order_by(
+                model.Player.id).limit(self.player_chunk_size).all()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1].id
+
+    def prioritize(self):
+        """Return the profiles of the players sorted by priority.
+
+        Players carried over from the last run come first, followed by
+        players active in the current season, players that played in the
+        last week and players in higher leagues. Each profile is
+        represented by the player entry with the lowest id.
+        """
+        carried = set(self.db_session.query(
+            model.CarriedPlayer.server, model.CarriedPlayer.realm,
+            model.CarriedPlayer.player_id))
+        recently = datetime.now() - timedelta(days=7)
+        priorities = {}
+        for (entry_id, server, realm, player_id, last_played,
+             last_active_season, league) in self.iter_profiles():
+            key = (server, realm, player_id)
+            priority = (
+                key not in carried,
+                last_active_season != self.season_ids.get(server.id()),
+                last_played is None or last_played < recently,
+                -(league.value if league is not None else -2),
+                -(last_played.timestamp() if last_played else 0.0))
+            if key in priorities:
+                best, first = priorities[key]
+                priorities[key] = (min(best, priority), min(first, entry_id))
+            else:
+                priorities[key] = (priority, entry_id)
+        return [Profile(entry_id, *key) for key, (_, entry_id) in sorted(
+            priorities.items(), key=lambda item: item[1])]
+
+    def iter_players(self, profiles, consumed):
+        """Load and yield the players of the profiles chunk by chunk.
+
+        The number of yielded profiles is counted in consumed[0].
+        """
+        for start in range(0, len(profiles), self.player_chunk_size):
+            chunk = profiles[start:start + self.player_chunk_size]
+            self.load_ladder_cache(chunk)
+            players = {player.id: player for player in
+                       self.db_session.query(model.Player).filter(
+                           model.Player.id.in_(
+                               [profile.id for profile in chunk]))}
+            for profile in chunk:
+                consumed[0] += 1
+                player = players.pop(profile.id, None)
+                if player is not None:
+                    yield player
+
+    def release(self, item):
+        """Remove the processed objects of a player from the session."""
+        players = [item['player']]
+        players.extend(data['player']
+                       for data in item.get('complete_data', []))
+        for player in players:
+            for entry in (player, player.__dict__.get('statistics'),
+                          player.__dict__.get('leaderboard')):
+                if entry is not None and entry in self.db_session:
+                    self.db_session.expunge(entry)
+
+    async def query_players(self, profiles):
+        """Query the players of the profiles in a pipeline of stages.
+
+        The players are fetched, reconciled and persisted by
+        fetch_concurrency, reconcile_concurrency and persist_concurrency
+        workers connected by queues holding at most pipeline_queue_size
+        players. Once a player would likely not be finished before the
+        deadline, no new players are fetched. Return the profiles left
+        unprocessed.
+        """
+        consumed = [0]
+        pending = self.iter_players(profiles, consumed)
+        left = []
+        done = [0, 0.0]
+        fetched = asyncio.Queue(self.pipeline_queue_size)
+        reconciled = asyncio.Queue(self.pipeline_queue_size)
+
+        async def fetch():
+            for player in pending:
+                if self.deadline is not None:
+                    expected = done[1] / done[0] if done[0] else 0.0
+                    if time.monotonic() + expected >= self.deadline:
+                        left.append(player.id)
+                        return
+                item = {'player': player, 'started': time.monotonic()}
+                if await self.run_stage(self.fetch_player, item):
+                    await fetched.put(item)
+
+        async def reconcile():
+            while True:
+                item = await fetched.get()
+                if item is None:
+                    return
+                if await self.run_stage(self.reconcile_player, item):
+                    await reconciled.put(item)
+
+        async def persist():
+            while True:
+                item = await reconciled.get()
+                if item is None:
+                    return
+                player = item['player']
+                if await self.run_stage(self.persist_player, item):
+                    self.sql_stats.finish_player(player.id)
+                    if self.run_entry is not None:
+                        self.checkpoint(player)
+                    self.release(item)
+                done[0] += 1
+                done[1] += time.monotonic() - item['started']
+
+        async def supervise(coros):
+            # If a task fails or the run is cancelled, all tasks are
+            # cancelled and awaited, none is left waiting on a queue.
+            tasks = [asyncio.ensure_future(coro) for coro in coros]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        async def stage(worker, workers, output=None, consumers=0):
+            await supervise([worker() for _ in range(workers)])
+            for _ in range(consumers):
+                await output.put(None)
+
+        fetchers = len(profiles)
+        if self.fetch_concurrency > 0:
+            fetchers = min(self.fetch_concurrency, fetchers)
+        reconcilers = max(1, self.reconcile_concurrency)
+        persisters = max(1, self.persist_concurrency)
+        await supervise([
+            stage(fetch, fetchers, fetched, reconcilers),
+            stage(reconcile, reconcilers, reconciled, persisters),
+            stage(persist, persisters)])
+        left = set(left)
+        return ([profile for profile in profiles if profile.id in left]
+                + profiles[consumed[0]:])
+
+    async def run_stage(self, step, item):
+        """Run a pipeline step of a player and return if it succeeded.
+
+        Failed and deferred players are dropped from the pipeline and
+        released.
+        """
+        player = item['player']
+        token = current_player.set(player.id)
+        try:
+            await step(item)
+            return True
+        except CircuitOpenError as error:
+            self.deferred_players.add(player.id)
+            logger.info(f'{player.id}: Deferred to the next run ({error}).')
+        except Exception:
+            logger.exception('The following exception was'
+                             f' raised while quering player {player.id}:')
+        finally:
+            current_player.reset(token)
+        self.sql_stats.finish_player(player.id)
+        self.release(item)
+        return False
+
+    def carry_over(self, profiles):
+        """Store the profiles to be processed first by the next run."""
+        self.db_session.query(model.CarriedPlayer).delete()
+        for profile in profiles:
+            self.db_session.add(model.CarriedPlayer(
+                player_id=profile.player_id, realm=profile.realm,
+                server=profile.server))
+        self.db_session.commit()
 
-        self.delete_old_logs_and_runs()
+    async def run_steps(self):
+        """Update the seasons, players, leaderboard and prune old data."""
+        with self.metrics.phase('update_seasons'):
+            await self.update_seasons()
+        with self.metrics.phase('rollover_seasons'):
+            await self.rollover_seasons()
+        if self.crawl_mode:
+            with self.metrics.phase('crawl_ladders'):
+                await self.crawl_ladders()
+
+        profiles = self.prioritize()
+        self.players_due = len(profiles)
+        profiles = [profile for profile in profiles
+                    if profile[1:] not in self.completed_players]
+
+        with self.metrics.phase('query_players'):
+            left = await self.query_players(profiles)
+        self.crawled = {}
+        self.ladder_cache = {}
+        self.players_processed = (self.players_due - len(left)
+                                  - len(self.deferred_players))
+        if left:
+            logger.warning(f'{len(left)} players were left unprocessed'
+                           ' as the time budget of the run ran out.')
+        self.carry_over(left + [profile for profile in profiles
+                                if profile.id in self.deferred_players])
 
-        duration = time.time() - start_time
-        self.db_session.add(
-            model.Run(duration=duration,
-                      api_requests=self.sc2api.request_count,
-                      api_retries=self.sc2api.retry_count,
-                      warnings=self.handler.warnings,
-                      errors=self.handler.errors))
-        self.db_session.commit()
+        try:
+            with self.metrics.phase('update_leaderboard'):
+                # The players completed before a resume are not known as
+                # changed anymore, hence all entries are refreshed.
+                self.update_leaderboard(full=bool(self.completed_players))
+        except Exception:
+            self.db_session.rollback()
+            logger.exception(
+                'The following exception was'
+                ' raised while updating the leaderboard:')
 
-        logger.debug(f"Finished job performing {self.sc2api.request_count}"
-                     f" api requests ({self.sc2api.retry_count} retries)"
-                     f" in {duration:.2f} seconds.")
+        with self.metrics.phase('delete_old_logs_and_runs'):
+            self.delete_old_logs_and_runs()
@@ -0,0 +1,122 @@
+"""Pool of api client credentials spreading the requests."""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Credential:
+    """Api client credentials with their access token and rate budget.
+
+    The rate budget is a token bucket of `rate` requests per second (0 for
+    none) that allows bursts of up to one second worth of requests.
+    """
+
+    def __init__(self, key='', secret='', suffix='', rate=0.0):
+        """Init the credentials without an access token."""
+        self.key = key
+        self.secret = secret
+        self.suffix = suffix
+        self.rate = rate
+        self.access_token = ''
+        self.access_token_expiry = 0.0
+        try:
+            self.lock = asyncio.Lock()
+        except RuntimeError:
+            self.lock = None
+        self.refresh_task = None
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_until = 0.0
+        self._budget = rate
+        self._updated = time.monotonic()
+
+    @property
+    def name(self):
+        """Return the name of the credentials in metrics and logs."""
+        return self.suffix.lstrip('_') or '1'
+
+    def config_key(self, key):
+        """Return the config key of a value of these credentials."""
+        return key + self.suffix
+
+    def wait(self, now):
+        """Return the seconds until a request may be made."""
+        wait = self.throttled_until - now
+        if self.rate > 0.0:
+            budget = min(self.rate, self._budget
+                         + (now - self._updated) * self.rate)
+            wait = max(wait, (1.0 - budget) / self.rate)
+        return wait
+
+    def take(self, now):
+        """Spend the budget of a request."""
+        if self.rate > 0.0:
+            self._budget = min(self.rate, self._budget
+                               + (now - self._updated) * self.rate) - 1.0
+            self._updated = now
+        self.in_flight += 1
+        self.requests += 1
+
+
+class CredentialPool:
+    """Credentials selected by load.
+
+    Requests are made with the available credentials that have the least
+    requests in flight. Credentials that were throttled by the api are not
+    available for `throttle_backoff` seconds, unless they are the only
+    ones.
+    """
+
+    throttle_backoff = 5.0
+
+    def __init__(self, credentials=None):
+        """Init the pool with some credentials."""
+        self.credentials = list(credentials or [Credential()])
+
+    def __iter__(self):
+        """Iterate the credentials."""
+        return iter(self.credentials)
+
+    def __len__(self):
+        """Return the number of credentials."""
+        return len(self.credentials)
+
+    def __getitem__(self, idx):
+        """Return the credentials at an index."""
+        return self.credentials[idx]
+
+    async def acquire(self):
+        """Return the least loaded available credentials.
+
+        Wait until credentials become available if there are none.
+        """
+        while True:
+            now = time.monotonic()
+            available = [credential for credential in self.credentials
+                         if credential.wait(now) <= 0.0]
+            if available:
+                credential = min(available, key=lambda credential: (
+                    credential.in_flight, credential.requests))
+                credential.take(now)
+                return credential
+            await asyncio.sleep(min(credential.wait(now)
+                                    for credential in self.credentials))
+
+    def release(self, credential, throttled=False):
+        """Release credentials after a request.
+
+        Throttled credentials are set aside for a while if there are
+        others.
+        """
+        credential.in_flight -= 1
+        if throttled:
+            credential.throttled += 1
+            if len(self.credentials) > 1:
+                credential.throttled_until = (time.monotonic()
+                                              + self.throttle_backoff)
+                logger.info(f'Credentials {credential.name} were throttled,'
+                            f' using the others for'
+                            f' {self.throttle_backoff:.0f} seconds.')
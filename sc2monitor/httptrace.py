@@ -0,0 +1,74 @@
+"""Record connection-level latencies via aiohttp's TraceConfig hooks."""
+import time
+
+from aiohttp import TraceConfig
+
+from sc2monitor.transport import endpoint_family
+
+
+class HTTPTraceMetrics:
+    """Record DNS, connection and time to first byte metrics.
+
+    The samples are recorded to the metrics (kind `http`) with the names
+    `dns:<host>`, `connect:<host>` for newly created connections,
+    `reuse:<host>` for reused connections and `ttfb:<host>` as well as
+    `ttfb:<endpoint family>` for the time until the response headers
+    arrived. The decode time is recorded by the HTTPTransport.
+    """
+
+    def __init__(self, metrics):
+        """Init the recorder."""
+        self.metrics = metrics
+
+    def trace_config(self):
+        """Return a TraceConfig to be passed to the aiohttp session."""
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_dns_resolvehost_start.append(self.on_dns_start)
+        trace_config.on_dns_resolvehost_end.append(self.on_dns_end)
+        trace_config.on_connection_create_start.append(
+            self.on_connection_create_start)
+        trace_config.on_connection_create_end.append(
+            self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(
+            self.on_connection_reuseconn)
+        return trace_config
+
+    async def on_request_start(self, session, ctx, params):
+        """Remember the start and host of the request."""
+        ctx.start = time.perf_counter()
+        ctx.host = params.url.host
+
+    async def on_request_end(self, session, ctx, params):
+        """Record the time to the first byte (response headers)."""
+        if self.metrics.enabled:
+            elapsed = time.perf_counter() - ctx.start
+            self.metrics.record('http', f'ttfb:{ctx.host}', elapsed)
+            self.metrics.record(
+                'http', f'ttfb:{endpoint_family(params.url.path)}', elapsed)
+
+    async def on_dns_start(self, session, ctx, params):
+        """Remember the start of the DNS resolution."""
+        ctx.dns_start = time.perf_counter()
+
+    async def on_dns_end(self, session, ctx, params):
+        """Record the DNS resolution time."""
+        if self.metrics.enabled:
+            self.metrics.record('http', f'dns:{params.host}',
+                                time.perf_counter() - ctx.dns_start)
+
+    async def on_connection_create_start(self, session, ctx, params):
+        """Remember the start of the connection creation."""
+        ctx.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(self, session, ctx, params):
+        """Record the creation time of a new connection."""
+        if self.metrics.enabled:
+            self.metrics.record('http', f'connect:{ctx.host}',
+                                time.perf_counter() - ctx.connect_start)
+
+    async def on_connection_reuseconn(self, session, ctx, params):
+        """Count a reused connection."""
+        if self.metrics.enabled:
+            self.metrics.record('http', f'reuse:{ctx.host}', 0.0)
@@ -0,0 +1,129 @@
+"""Adaptive limit of the concurrent api requests."""
+import asyncio
+import logging
+from collections import deque
+
+from sc2monitor.metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimiter:
+    """Limit of the concurrent requests adjusted by AIMD.
+
+    The limit grows by one per successful request until it is decreased
+    for the first time (slow start) and by one per `limit` successful
+    requests (about once per round trip) afterwards. It is multiplied by
+    `decrease` if a request is overloaded (429, 504 or timeout) or the
+    p95 latency of the last `window` requests exceeds `latency_factor`
+    times the lowest p95 latency seen, but at most once per round trip.
+    The limit stays between `min_limit` and `max_limit`, a `max_limit`
+    of 0 disables the limiter.
+    """
+
+    def __init__(self, initial=4, min_limit=4, max_limit=100,
+                 decrease=0.5, latency_factor=2.0, window=50):
+        """Init the limiter without requests in flight."""
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.limit = float(min(max(initial, self.min_limit),
+                               max(max_limit, self.min_limit)))
+        self.in_flight = 0
+        self.latencies = deque(maxlen=window)
+        self.baseline = None
+        self.slow_start = True
+        self._since_decrease = 0
+        self._waiters = deque()
+
+    @property
+    def enabled(self):
+        """Return if the limiter is enabled."""
+        return self.max_limit > 0
+
+    @property
+    def current(self):
+        """Return the current (integral) limit."""
+        return int(self.limit)
+
+    async def acquire(self):
+        """Wait until a request may be made."""
+        while self.in_flight >= self.current:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    # Pass the wakeup on to the next waiter.
+                    self._wake()
+                else:
+                    try:
+                        self._waiters.remove(waiter)
+                    except ValueError:
+                        pass
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        """Release the slot of a finished request."""
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        """Wake as many waiters as there are free slots."""
+        free = self.current - self.in_flight
+        while self._waiters and free > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def record(self, overloaded, latency=None):
+        """Record the outcome of a request and adjust the limit.
+
+        Return True if the (integral) limit changed.
+        """
+        previous = self.current
+        self._since_decrease += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        if overloaded:
+            self._decrease('overloaded')
+        elif self._latency_increased():
+            self._decrease('p95 latency increased')
+        elif self.slow_start:
+            self.limit = min(self.limit + 1.0, self.max_limit)
+        else:
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+        if self.current > previous:
+            self._wake()
+        return self.current != previous
+
+    def _latency_increased(self):
+        """Return if the p95 latency exceeds the baseline."""
+        if len(self.latencies) < self.latencies.maxlen:
+            return False
+        p95 = percentile(sorted(self.latencies), 95)
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+            return False
+        if p95 <= self.latency_factor * self.baseline:
+            return False
+        if self.current <= self.min_limit:
+            # The api got slower regardless of the concurrency.
+            self.baseline = p95
+            return False
+        return True
+
+    def _decrease(self, reason):
+        """Decrease the limit once per round trip."""
+        if not self.slow_start and self._since_decrease < self.current:
+            return
+        self.slow_start = False
+        self._since_decrease = 0
+        self.latencies.clear()
+        self.limit = max(self.limit * self.decrease, self.min_limit)
+        logger.debug(f'Concurrency limit decreased to {self.current}'
+                     f' ({reason}).')
@@ -0,0 +1,231 @@
+"""Collect lightweight timing metrics of a run."""
+import asyncio
+import math
+import os
+import random
+import time
+
+import sc2monitor.model as model
+from sc2monitor.tracing import Tracer
+
+
+class _Timer:
+    """Context manager recording the time spent in its block."""
+
+    __slots__ = ('_metrics', '_kind', '_name', '_start')
+
+    def __init__(self, metrics, kind, name):
+        self._metrics = metrics
+        self._kind = kind
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.record_span(
+            self._kind, self._name, self._start, time.perf_counter())
+
+
+class _NullTimer:
+    """Context manager doing nothing if metrics are disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def percentile(samples, percent):
+    """Return the nearest-rank percentile of sorted samples."""
+    if not samples:
+        return 0.0
+    idx = max(0, math.ceil(percent / 100.0 * len(samples)) - 1)
+    return samples[idx]
+
+
+def current_rss():
+    """Return the resident set size of the process in KiB.
+
+    Return 0 if it is unknown (on other platforms than Linux).
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class PeakRSS:
+    """Peak resident set size of the process during a run.
+
+    The resident set size is sampled every `interval` seconds, unlike
+    the peak reported by getrusage, which covers the process lifetime.
+    """
+
+    def __init__(self, interval=0.5):
+        """Init the sampler."""
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    def start(self):
+        """Start sampling (from within the running event loop)."""
+        self.peak = current_rss()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+
+    def stop(self):
+        """Stop sampling and return the peak in KiB."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+    async def _sample(self):
+        """Record the resident set size periodically."""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.peak = max(self.peak, current_rss())
+
+
+class _Reservoir:
+    """Count and total of recorded values and a uniform sample of them.
+
+    The sample holds at most `size` values (reservoir sampling), so that
+    its memory does not grow with the number of recorded values.
+    """
+
+    __slots__ = ('count', 'total', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+
+    def add(self, value, size, rng):
+        self.count += 1
+        self.total += value
+        if len(self.samples) < size:
+            self.samples.append(value)
+        else:
+            idx = rng.randrange(self.count)
+            if idx < size:
+                self.samples[idx] = value
+
+
+class Metrics:
+    """Cumulative time, call count and latency percentiles per name.
+
+    Metrics are grouped by kind, e.g. `phase` for the steps of a run and
+    `endpoint` for the api endpoints. The percentiles are exact up to
+    `reservoir_size` samples per name and estimated from a uniform
+    sample of that size beyond. The timed blocks are also added as spans
+    to the tracer if it is enabled. If both are disabled, `phase` and
+    `endpoint` return a shared no-op context manager.
+    """
+
+    reservoir_size = 1000
+
+    def __init__(self, enabled=True, tracer=None):
+        """Init empty metrics."""
+        self.enabled = enabled
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.samples = {}
+        self._random = random.Random(0)
+
+    def reset(self):
+        """Remove all collected samples."""
+        self.samples = {}
+
+    def record(self, kind, name, seconds):
+        """Record a single sample."""
+        try:
+            reservoir = self.samples[(kind, name)]
+        except KeyError:
+            reservoir = self.samples[(kind, name)] = _Reservoir()
+        reservoir.add(seconds, self.reservoir_size, self._random)
+
+    def record_span(self, kind, name, start, end):
+        """Record a sample between two perf_counter values."""
+        if self.enabled:
+            self.record(kind, name, end - start)
+        if self.tracer.enabled:
+            self.tracer.add(kind, name, start, end)
+
+    def timer(self, kind, name):
+        """Return a context manager timing its block."""
+        if not self.enabled and not self.tracer.enabled:
+            return _NULL_TIMER
+        return _Timer(self, kind, name)
+
+    def phase(self, name):
+        """Return a context manager timing a phase of the run."""
+        return self.timer('phase', name)
+
+    def endpoint(self, name):
+        """Return a context manager timing a request to an api endpoint."""
+        return self.timer('endpoint', name)
+
+    def summary(self):
+        """Return count, total and percentiles per kind and name."""
+        summary = {}
+        for key, reservoir in self.samples.items():
+            samples = sorted(reservoir.samples)
+            summary[key] = {'count': reservoir.count,
+                            'total': reservoir.total,
+                            'p50': percentile(samples, 50),
+                            'p95': percentile(samples, 95),
+                            'p99': percentile(samples, 99)}
+        return summary
+
+    def to_models(self):
+        """Return the collected metrics as RunMetric database entries."""
+        return [model.RunMetric(kind=kind, name=name, **values)
+                for (kind, name), values in sorted(self.summary().items())]
+
+
+class PoolMetrics:
+    """Record the time waited for a connection of an engine's pool.
+
+    The samples are recorded to the metrics (kind `db`, name `checkout`).
+    """
+
+    def __init__(self, metrics):
+        """Init the recorder."""
+        self.metrics = metrics
+        self.pool = None
+
+    def attach(self, engine):
+        """Time the connection checkouts of the engine's pool."""
+        self.detach()
+        self.pool = engine.pool
+        connect = self.pool.connect
+
+        def timed_connect():
+            if not self.metrics.enabled:
+                return connect()
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                self.metrics.record('db', 'checkout',
+                                    time.perf_counter() - start)
+
+        # The pool has no event before waiting for a connection.
+        self.pool.connect = timed_connect
+
+    def detach(self):
+        """Stop timing the connection checkouts."""
+        if self.pool is not None:
+            del self.pool.connect
+            self.pool = None
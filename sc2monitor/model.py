@@ -3,12 +3,59 @@ import enum
 from datetime import datetime
 
 from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, ForeignKey,
-                        Integer, String, UniqueConstraint, create_engine, text)
+                        Index, Integer, String, UniqueConstraint,
+                        create_engine, delete, event, func, inspect, select,
+                        text)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 Base = declarative_base()
 
+# Increase whenever tables or columns are added, so that existing
+# databases are updated once. Missing tables are created by create_all,
+# columns added to existing tables are listed in ADDED_COLUMNS.
+SCHEMA_VERSION = 5
+# Version adding the natural key of matches, see migrate_match_key.
+MATCH_KEY_VERSION = 4
+# Columns added to existing tables by version, see migrate_columns.
+# Databases without a version are from before versioning (version 0).
+ADDED_COLUMNS = {
+    1: [('runs', 'sql_statements'), ('runs', 'sql_time')],
+    2: [('runs', 'deferred_players'), ('runs', 'coalesced_requests'),
+        ('runs', 'players_due'), ('runs', 'players_processed')],
+    3: [('runs', 'finished')],
+    4: [('runs', 'peak_rss')],
+    5: [('runs', 'concurrency_limit')],
+}
+_checked_schemas = set()
+
+# Options of create_engine by profile name, see create_db_session.
+ENGINE_PROFILES = {
+    'default': {},
+    'mysql': {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        # Replace connections closed by the server after being idle.
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,
+        'isolation_level': 'READ COMMITTED',
+    },
+}
+
+# Pragmas of the SQLite performance profile, see create_db_session.
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # KiB
+    'mmap_size': 268435456,  # bytes
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # ms
+}
+
 
 class Result(enum.Enum):
     """Result of a ladder match."""
@@ -324,6 +371,10 @@ class Player(Base):
                               back_populates="player",
                               uselist=False,
                               cascade="save-update, merge, delete")
+    leaderboard = relationship("Leaderboard",
+                               back_populates="player",
+                               uselist=False,
+                               cascade="save-update, merge, delete")
 
     def __repr__(self):
         """Represent database object."""
@@ -338,6 +389,10 @@ class Match(Base):
     """Match database entry."""
 
     __tablename__ = "match"
+    __table_args__ = (
+        Index('ix_match_natural', 'player_id', 'datetime', 'result',
+              unique=True),
+    )
     id = Column(Integer, primary_key=True)
     player_id = Column(Integer, ForeignKey('player.id'))
     player = relationship(Player, back_populates="matches", uselist=False)
@@ -388,6 +443,87 @@ class Statistics(Base):
                 f'games={self.games})>')
 
 
+class Leaderboard(Base):
+    """Denormalized and pre-ranked leaderboard database entry."""
+
+    __tablename__ = "leaderboard"
+    __table_args__ = (
+        Index('ix_leaderboard_rank', 'rank'),
+        Index('ix_leaderboard_server_rank', 'server', 'server_rank'),
+        Index('ix_leaderboard_race_rank', 'race', 'race_rank'),
+    )
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, ForeignKey('player.id'), unique=True)
+    player = relationship(Player, back_populates="leaderboard", uselist=False)
+    name = Column(String(64), default='')
+    server = Column(Enum(Server), default=Server.Europe)
+    race = Column(Enum(Race), default=Race.Random)
+    league = Column(Enum(League), default=League.Unranked)
+    mmr = Column(Integer, default=0)
+    wins = Column(Integer, default=0)
+    losses = Column(Integer, default=0)
+    winrate = Column(Float, default=0.0)
+    trend = Column(Float, default=0.0)
+    last_played = Column(DateTime)
+    rank = Column(Integer, default=0)
+    server_rank = Column(Integer, default=0)
+    race_rank = Column(Integer, default=0)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<Leaderboard(id={self.id}, player={self.player_id}, '
+                f'rank={self.rank}, server_rank={self.server_rank}, '
+                f'race_rank={self.race_rank}, mmr={self.mmr})>')
+
+
+class CarriedPlayer(Base):
+    """Player profile left unprocessed by a run database entry."""
+
+    __tablename__ = "carried_players"
+    __table_args__ = (
+        UniqueConstraint('player_id', 'realm', 'server'),
+    )
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer)
+    realm = Column(Integer, default=1)
+    server = Column(Enum(Server), default=Server.Europe)
+    carried = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<CarriedPlayer(id={self.id}, player_id={self.player_id}, '
+                f'server={self.server}, realm={self.realm})>')
+
+
+class LadderMembership(Base):
+    """Cached 1v1 ladders of a player profile database entry."""
+
+    __tablename__ = "ladder_memberships"
+    __table_args__ = (
+        UniqueConstraint('player_id', 'realm', 'server'),
+    )
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer)
+    realm = Column(Integer, default=1)
+    server = Column(Enum(Server), default=Server.Europe)
+    ladder_ids = Column(String(255), default='')  # comma-separated
+    season_id = Column(Integer, default=0)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    @property
+    def ladders(self):
+        """Return the set of cached ladder ids."""
+        return {int(ladder_id) for ladder_id in self.ladder_ids.split(',')
+                if ladder_id}
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<LadderMembership(id={self.id}, '
+                f'player_id={self.player_id}, server={self.server}, '
+                f'realm={self.realm}, ladder_ids={self.ladder_ids})>')
+
+
 class Log(Base):
     """Log database entry."""
 
@@ -427,6 +563,27 @@ class Run(Base):
     api_retries = Column(Integer, default=0)
     warnings = Column(Integer, default=0)
     errors = Column(Integer, default=0)
+    sql_statements = Column(Integer, default=0)
+    sql_time = Column(Float, default=0.0)
+    deferred_players = Column(Integer, default=0)
+    coalesced_requests = Column(Integer, default=0)
+    players_due = Column(Integer, default=0)
+    players_processed = Column(Integer, default=0)
+    finished = Column(Boolean, default=True)
+    peak_rss = Column(Integer, default=0)  # KiB
+    concurrency_limit = Column(Integer)
+    metrics = relationship("RunMetric",
+                           back_populates="run",
+                           cascade="save-update, merge, delete")
+    statements = relationship("RunStatement",
+                              back_populates="run",
+                              cascade="save-update, merge, delete")
+    profile = relationship("RunProfile",
+                           back_populates="run",
+                           cascade="save-update, merge, delete")
+    checkpoints = relationship("RunCheckpoint",
+                               back_populates="run",
+                               cascade="save-update, merge, delete")
 
     def __repr__(self):
         """Represent database object."""
@@ -436,14 +593,265 @@ class Run(Base):
                 f'api_retries={self.api_retries}, warnings={self.warnings}, '
                 f'errors={self.errors}>')
 
+    @property
+    def coverage(self):
+        """Return the share of the due players that were processed."""
+        if not self.players_due:
+            return 1.0
+        return self.players_processed / self.players_due
+
 
-def create_db_session(db='', encoding=''):
-    """Create a new database session."""
+class RunMetric(Base):
+    """Timing metric of a run database entry."""
+
+    __tablename__ = "run_metrics"
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('runs.id'), index=True)
+    run = relationship(Run, back_populates="metrics", uselist=False)
+    kind = Column(String(16))
+    name = Column(String(64))
+    count = Column(Integer, default=0)
+    total = Column(Float, default=0.0)
+    p50 = Column(Float, default=0.0)
+    p95 = Column(Float, default=0.0)
+    p99 = Column(Float, default=0.0)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<RunMetric(id={self.id}, run={self.run_id}, '
+                f'kind={self.kind}, name={self.name}, count={self.count}, '
+                f'total={self.total:.3f})>')
+
+
+class RunStatement(Base):
+    """SQL statement fingerprint executed during a run database entry."""
+
+    __tablename__ = "run_statements"
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('runs.id'), index=True)
+    run = relationship(Run, back_populates="statements", uselist=False)
+    fingerprint = Column(String(1024))
+    count = Column(Integer, default=0)
+    rows = Column(Integer, default=0)
+    total = Column(Float, default=0.0)
+    max_per_player = Column(Integer, default=0)
+    flagged_players = Column(Integer, default=0)
+    n_plus_one = Column(Boolean, default=False)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<RunStatement(id={self.id}, run={self.run_id}, '
+                f'count={self.count}, total={self.total:.3f}, '
+                f'n_plus_one={self.n_plus_one}, '
+                f'fingerprint={self.fingerprint[:100]})>')
+
+
+class RunProfile(Base):
+    """Profiled function or allocation site of a run database entry."""
+
+    __tablename__ = "run_profile"
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('runs.id'), index=True)
+    run = relationship(Run, back_populates="profile", uselist=False)
+    kind = Column(String(16))
+    name = Column(String(255))
+    count = Column(Integer, default=0)
+    total = Column(Float, default=0.0)
+    cumulative = Column(Float, default=0.0)
+    size = Column(Integer, default=0)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<RunProfile(id={self.id}, run={self.run_id}, '
+                f'kind={self.kind}, name={self.name}, count={self.count}, '
+                f'cumulative={self.cumulative}, size={self.size})>')
+
+
+class RunCheckpoint(Base):
+    """Player profile completed by an unfinished run database entry."""
+
+    __tablename__ = "run_checkpoints"
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('runs.id'), index=True)
+    run = relationship(Run, back_populates="checkpoints", uselist=False)
+    player_id = Column(Integer)
+    realm = Column(Integer, default=1)
+    server = Column(Enum(Server), default=Server.Europe)
+
+    def __repr__(self):
+        """Represent database object."""
+        return (f'<RunCheckpoint(id={self.id}, run={self.run_id}, '
+                f'player_id={self.player_id}, server={self.server}, '
+                f'realm={self.realm})>')
+
+
+def create_db_session(db='', encoding='', sqlite_profile=None,
+                      engine_profile=None):
+    """Create a new database session.
+
+    The engine is created with the options of engine_profile, which is
+    either a name of ENGINE_PROFILES or a dict of create_engine options.
+    If sqlite_profile is set and db is an SQLite file, the pragmas of
+    SQLITE_PROFILE (updated by sqlite_profile if it is a dict) are set
+    on connect and all writes go through a single connection.
+    """
     if not db:
         db = 'sqlite:///sc2monitor.db'
     if not encoding:
         encoding = 'utf8'
-    engine = create_engine(db, encoding=encoding)
-    Base.metadata.create_all(engine)
+    kwargs = engine_options(engine_profile)
+    pragmas = sqlite_pragmas(db, sqlite_profile)
+    if pragmas:
+        kwargs['poolclass'] = StaticPool
+    engine = create_engine(db, encoding=encoding, **kwargs)
+    if pragmas:
+        listen_pragmas(engine, pragmas)
+    check_schema(engine)
     Base.metadata.bind = engine
     return sessionmaker(bind=engine)()
+
+
+def create_report_session(db='', encoding='', sqlite_profile=None):
+    """Create a read-only database session, e.g. for reporting.
+
+    With the SQLite profile, these sessions read concurrently to the
+    writing controller from their own connections.
+    """
+    if not db:
+        db = 'sqlite:///sc2monitor.db'
+    if not encoding:
+        encoding = 'utf8'
+    engine = create_engine(db, encoding=encoding)
+    pragmas = sqlite_pragmas(db, sqlite_profile)
+    if pragmas:
+        # The journal mode is persistent and set by the writer.
+        pragmas.pop('journal_mode', None)
+        pragmas['query_only'] = 'ON'
+        listen_pragmas(engine, pragmas)
+    return sessionmaker(bind=engine)()
+
+
+def engine_options(engine_profile):
+    """Return the create_engine options of an engine profile."""
+    if not engine_profile:
+        return {}
+    if isinstance(engine_profile, dict):
+        return dict(engine_profile)
+    try:
+        return dict(ENGINE_PROFILES[engine_profile])
+    except KeyError:
+        raise ValueError(
+            f"Unknown engine profile '{engine_profile}'"
+            f" (valid profiles: {', '.join(ENGINE_PROFILES)})")
+
+
+def sqlite_pragmas(db, sqlite_profile):
+    """Return the pragmas of the profile if it applies to the database."""
+    url = make_url(db)
+    if (not sqlite_profile or url.get_backend_name() != 'sqlite'
+            or url.database in (None, '', ':memory:')):
+        return {}
+    pragmas = dict(SQLITE_PROFILE)
+    if isinstance(sqlite_profile, dict):
+        pragmas.update(sqlite_profile)
+    return pragmas
+
+
+def listen_pragmas(engine, pragmas):
+    """Set the pragmas on every new connection of the engine."""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f'PRAGMA {key}={value}')
+        cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
+
+
+def check_schema(engine):
+    """Create missing tables and columns if the schema version is outdated.
+
+    The version is stored in the config table and is only checked once
+    per process and database (except for in-memory databases).
+    """
+    url = str(engine.url)
+    cache = engine.url.database not in (None, '', ':memory:')
+    if cache and url in _checked_schemas:
+        return
+    try:
+        with engine.connect() as connection:
+            version = connection.execute(
+                select(Config.value).where(
+                    Config.key == 'schema_version')).scalar()
+    except DBAPIError:
+        version = None
+
+    if version != str(SCHEMA_VERSION):
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            migrate_columns(connection, int(version or 0))
+            if int(version or 0) < MATCH_KEY_VERSION and not any(
+                    index['name'] == 'ix_match_natural' for index in
+                    inspect(connection).get_indexes('match')):
+                migrate_match_key(connection)
+            if version is None:
+                connection.execute(Config.__table__.insert().values(
+                    key='schema_version', value=str(SCHEMA_VERSION)))
+            else:
+                connection.execute(Config.__table__.update().where(
+                    Config.key == 'schema_version').values(
+                    value=str(SCHEMA_VERSION)))
+    if cache:
+        _checked_schemas.add(url)
+
+
+def migrate_columns(connection, version):
+    """Add the columns missing from tables created before version.
+
+    Columns that already exist are skipped, so that tables created by
+    create_all or by a partly updated database are left as they are.
+    """
+    existing = {}
+    preparer = connection.dialect.identifier_preparer
+    for added, columns in sorted(ADDED_COLUMNS.items()):
+        if added <= version:
+            continue
+        for table, name in columns:
+            if table not in existing:
+                existing[table] = {column['name'] for column in inspect(
+                    connection).get_columns(table)}
+            if name in existing[table]:
+                continue
+            column = Base.metadata.tables[table].c[name]
+            connection.execute(text(
+                f'ALTER TABLE {preparer.quote(table)} ADD COLUMN'
+                f' {preparer.quote(name)}'
+                f' {column.type.compile(dialect=connection.dialect)}'))
+            existing[table].add(name)
+
+
+def migrate_match_key(connection):
+    """Delete duplicate matches and add the natural key of matches."""
+    keep = select(func.min(Match.id)).group_by(
+        Match.player_id, Match.datetime, Match.result).subquery()
+    connection.execute(delete(Match.__table__).where(
+        Match.id.notin_(select(keep.c[0]))))
+    for index in Match.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def insert_ignore(table, dialect):
+    """Return an insert into table skipping rows violating a unique key.
+
+    Supported by SQLite and PostgreSQL (ON CONFLICT DO NOTHING) and MySQL
+    (INSERT IGNORE), other dialects fall back to a plain insert.
+    """
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
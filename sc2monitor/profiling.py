@@ -0,0 +1,104 @@
+"""Profile a run with cProfile, tracemalloc and event loop lag sampling."""
+import asyncio
+import cProfile
+import os
+import pstats
+import tracemalloc
+
+import sc2monitor.model as model
+
+
+def short_path(path, components=2):
+    """Return the last components of a file path."""
+    parts = os.path.normpath(path).split(os.sep)
+    return '/'.join(parts[-components:])
+
+
+class Profiler:
+    """Profile the functions, allocations and event loop lag of a run.
+
+    The top `top` functions by cumulative time and allocation sites by
+    size are converted to RunProfile entries, the event loop lag sampled
+    every `interval` seconds is recorded to the metrics of the run.
+    """
+
+    def __init__(self, metrics, top=20, interval=0.1, frames=1):
+        """Init the profiler."""
+        self.metrics = metrics
+        self.top = top
+        self.interval = interval
+        self.frames = frames
+        self.profile = cProfile.Profile()
+        self.snapshot = None
+        self.peak = 0
+        self._tracing = False
+        self._lag_task = None
+        self._running = False
+
+    def start(self):
+        """Start profiling (from within the running event loop)."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._tracing = True
+        elif hasattr(tracemalloc, 'reset_peak'):
+            # Python >= 3.9
+            tracemalloc.reset_peak()
+        self._lag_task = asyncio.get_running_loop().create_task(
+            self._sample_lag())
+        self.profile.enable()
+        self._running = True
+
+    def stop(self):
+        """Stop profiling and take the allocation snapshot."""
+        if not self._running:
+            return
+        self._running = False
+        self.profile.disable()
+        self._lag_task.cancel()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.peak = tracemalloc.get_traced_memory()[1]
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    async def _sample_lag(self):
+        """Record how much later than scheduled the loop wakes up."""
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.metrics.record('event_loop', 'lag',
+                                max(0.0, loop.time() - scheduled))
+
+    def functions(self):
+        """Return the top functions by cumulative time."""
+        stats = pstats.Stats(self.profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3],
+                     reverse=True)[:self.top]
+        return [(f'{short_path(filename)}:{line}({function})',
+                 calls, total, cumulative)
+                for (filename, line, function),
+                (_, calls, total, cumulative, _) in top]
+
+    def allocations(self):
+        """Return the top allocation sites by size."""
+        if self.snapshot is None:
+            return []
+        snapshot = self.snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),))
+        return [(f'{short_path(stat.traceback[0].filename)}:'
+                 f'{stat.traceback[0].lineno}', stat.count, stat.size)
+                for stat in snapshot.statistics('lineno')[:self.top]]
+
+    def to_models(self):
+        """Return the profile as RunProfile database entries."""
+        entries = [model.RunProfile(kind='function', name=name[:255],
+                                    count=calls, total=total,
+                                    cumulative=cumulative)
+                   for name, calls, total, cumulative in self.functions()]
+        entries.extend(model.RunProfile(kind='allocation', name=name[:255],
+                                        count=count, size=size)
+                       for name, count, size in self.allocations())
+        entries.append(model.RunProfile(kind='memory', name='peak',
+                                        size=self.peak))
+        return entries
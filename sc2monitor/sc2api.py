@@ -2,12 +2,15 @@
 import asyncio
 import logging
 import re
-from datetime import datetime, timedelta
-
-from aiohttp import BasicAuth
-from aiohttp.client_exceptions import ClientResponseError, ContentTypeError
+import time
+from datetime import datetime
 
 import sc2monitor.model as model
+from sc2monitor.breaker import CLOSED, CircuitBreakers, CircuitOpenError
+from sc2monitor.credentials import Credential, CredentialPool
+from sc2monitor.limiter import ConcurrencyLimiter
+from sc2monitor.transport import (HTTPTransport, endpoint_family,
+                                  endpoint_region, request_key)
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +18,11 @@ logger = logging.getLogger(__name__)
 class SC2API:
     """Wrapper for the SC2 api."""
 
+    api_url = 'https://eu.api.blizzard.com'
+    oauth_url = 'https://eu.battle.net'
+    # Seconds before its expiry an access token is replaced.
+    token_margin = 3600
+
     def __init__(self, controller):
         """Init the sc2 api."""
         self._controller = controller
@@ -22,17 +30,16 @@ class SC2API:
             self._session = self._controller.http_session
         except AttributeError:
             self._session = None
-        self._key = ''
-        self._secret = ''
-        self._access_token = ''
-        self._access_token_checked = False
+        self.metrics = self._controller.metrics
+        self.transport = HTTPTransport(self._session, self.metrics)
+        self.credentials = CredentialPool()
         self.read_config()
-        try:
-            self._access_token_lock = asyncio.Lock()
-        except RuntimeError:
-            self._access_token_lock = None
         self.request_count = 0
         self.retry_count = 0
+        self.breakers = CircuitBreakers(error_rate=0.0)
+        self.limiter = ConcurrencyLimiter(max_limit=0)
+        self.coalesced_count = 0
+        self._in_flight = {}
 
         self._precompile()
 
@@ -48,57 +55,152 @@ class SC2API:
             re.IGNORECASE)
 
     def read_config(self):
-        """Read the api key and secret from the config."""
-        self._key = self._controller.get_config(
-            'api_key', raise_key_error=False)
-        self._secret = self._controller.get_config(
-            'api_secret', raise_key_error=False)
+        """Read the api credentials from the config.
+
+        Additional credentials are read from the keys `api_key_2`,
+        `api_secret_2`, `api_key_3` and so on.
+        """
+        rate = float(self._controller.get_config(
+            'api_rate_limit', default_value=100))
+        known = {(credential.key, credential.secret): credential
+                 for credential in self.credentials}
+        credentials = []
+        suffix = ''
+        while True:
+            key = self._controller.get_config(
+                'api_key' + suffix, raise_key_error=False)
+            secret = self._controller.get_config(
+                'api_secret' + suffix, raise_key_error=False)
+            if suffix and not key:
+                break
+            credential = known.get((key, secret))
+            if credential is None or credential.suffix != suffix:
+                credential = Credential(key, secret, suffix)
+            credential.rate = rate
+            self._read_access_token(credential)
+            credentials.append(credential)
+            suffix = f'_{len(credentials) + 1}'
+        self.credentials.credentials = credentials
+
+    def _read_access_token(self, credential):
+        """Read the stored access token of credentials."""
         new_token = self._controller.get_config(
-            'access_token', raise_key_error=False)
-
-        if self._access_token != new_token:
-            self._access_token = new_token
-            self._access_token_checked = False
-
-    async def check_access_token(self, token):
+            credential.config_key('access_token'), raise_key_error=False)
+        if credential.access_token != new_token:
+            credential.access_token = new_token
+            credential.access_token_expiry = float(
+                self._controller.get_config(
+                    credential.config_key('access_token_expiry'),
+                    default_value=0))
+
+    def access_token_valid(self, credential=None):
+        """Return if the access token is known to be valid for a while."""
+        credential = credential or self.credentials[0]
+        return (bool(credential.access_token) and time.time()
+                < credential.access_token_expiry - self.token_margin)
+
+    def _set_access_token_expiry(self, credential, expiry):
+        """Store the expiry of the access token."""
+        credential.access_token_expiry = float(expiry)
+        self._controller.set_config(
+            credential.config_key('access_token_expiry'),
+            str(int(credential.access_token_expiry)))
+
+    async def check_access_token(self, token, credential=None):
         """Check if the access token is valid for at least an hour."""
-        async with self._session.get(
-                'https://eu.battle.net/oauth/check_token',
-                params={'token': token}) as resp:
-            self.request_count += 1
-            valid = resp.status == 200
-            if valid:
-                json = await resp.json()
-                exp = datetime.fromtimestamp(json['exp'])
-                valid = valid and exp - datetime.now() >= timedelta(hours=1)
-            self._access_token_checked = valid
-        return self._access_token_checked
-
-    async def get_access_token(self):
-        """Get an valid access token."""
-        async with self._access_token_lock:
-            if (not self._access_token
-                or (not self._access_token_checked
-                    and not await self.check_access_token(
-                        self._access_token))):
-                await self.receive_new_access_token()
-            return self._access_token
-
-    async def receive_new_access_token(self):
+        credential = credential or self.credentials[0]
+        with self.metrics.endpoint('check_token'):
+            resp = await self.transport.request(
+                'GET', f'{self.oauth_url}/oauth/check_token',
+                params={'token': token})
+        self.request_count += 1
+        if resp.status != 200 or resp.data is None:
+            return False
+        if token == credential.access_token:
+            self._set_access_token_expiry(credential, resp.data['exp'])
+        return resp.data['exp'] - time.time() >= self.token_margin
+
+    async def get_access_token(self, credential=None):
+        """Get an valid access token.
+
+        The stored expiry of the token is trusted, the lock is only taken
+        if the token has to be checked or replaced.
+        """
+        credential = credential or self.credentials[0]
+        if self.access_token_valid(credential):
+            return credential.access_token
+        async with credential.lock:
+            await self._renew_access_token(credential)
+            return credential.access_token
+
+    async def _renew_access_token(self, credential):
+        """Check or replace the access token unless it is still valid."""
+        if self.access_token_valid(credential):
+            return
+        if credential.access_token and not credential.access_token_expiry:
+            # The expiry of tokens stored by older versions is unknown.
+            if await self.check_access_token(credential.access_token,
+                                             credential):
+                return
+        await self.receive_new_access_token(credential)
+
+    def drop_access_token(self, credential, token):
+        """Drop an access token rejected by the api.
+
+        The next request renews it, unless it was already replaced.
+        """
+        if credential.access_token != token:
+            return
+        credential.access_token = ''
+        credential.access_token_expiry = 0.0
+        logger.warning(f'Access token of credentials {credential.name}'
+                       ' was rejected.')
+
+    def start_token_refresh(self):
+        """Refresh the access tokens in the background before they expire."""
+        for credential in self.credentials:
+            if credential.refresh_task is None:
+                credential.refresh_task = asyncio.create_task(
+                    self._refresh_loop(credential))
+
+    async def _refresh_loop(self, credential):
+        """Renew the access token whenever it is about to expire."""
+        while True:
+            # Foreground requests renew an expired token themselves.
+            await asyncio.sleep(max(60.0, credential.access_token_expiry
+                                    - self.token_margin - time.time()))
+            try:
+                async with credential.lock:
+                    await self._renew_access_token(credential)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to refresh the access token'
+                                 f' of credentials {credential.name}:')
+                await asyncio.sleep(60)
+
+    async def receive_new_access_token(self, credential=None):
         """Receive a new acces token vai oauth."""
+        from aiohttp import BasicAuth
+
+        credential = credential or self.credentials[0]
         data, status = await self._perform_api_post_request(
-            'https://eu.battle.net/oauth/token',
+            f'{self.oauth_url}/oauth/token',
             auth=BasicAuth(
-                self._key, self._secret),
+                credential.key, credential.secret),
             params={'grant_type': 'client_credentials'})
 
         if status != 200:
             raise InvalidApiResponse(status)
 
-        self._access_token = data.get('access_token')
-        self._access_token_checked = True
-        self._controller.set_config('access_token', self._access_token)
-        logger.info('New access token received.')
+        credential.access_token = data.get('access_token')
+        self._controller.set_config(credential.config_key('access_token'),
+                                    credential.access_token, commit=False)
+        expires_in = data.get('expires_in')
+        self._set_access_token_expiry(
+            credential, time.time() + int(expires_in) if expires_in else 0)
+        logger.info(f'New access token of credentials {credential.name}'
+                    ' received.')
 
     def parse_profile_url(self, url):
         """Parse a profile URL for the server, the realm and the profile ID."""
@@ -119,10 +221,9 @@ class SC2API:
 
     async def get_season(self, server: model.Server):
         """Collect the current season info."""
-        api_url = ('https://eu.api.blizzard.com/sc2/'
+        api_url = (f'{self.api_url}/sc2/'
                    f'ladder/season/{server.id()}')
-        payload = {'locale': 'en_US',
-                   'access_token': await self.get_access_token()}
+        payload = {'locale': 'en_US'}
         data, status = await self._perform_api_request(api_url, params=payload)
         if status != 200:
             raise InvalidApiResponse(f'{status}: {api_url}')
@@ -157,14 +258,90 @@ class SC2API:
         return await self._get_match_history(
             player.server, player.realm, player.player_id)
 
+    async def get_grandmaster_ladder(self, server: model.Server):
+        """Collect the members of the grandmaster ladder of a region.
+
+        Return their ladder data by realm and profile id. The ladder id
+        is not part of the response and thus None.
+        """
+        api_url = (f'{self.api_url}/sc2/'
+                   f'ladder/grandmaster/{server.id()}')
+        payload = {'locale': 'en_US'}
+        data, status = await self._perform_api_request(api_url, params=payload)
+        if status != 200:
+            raise InvalidApiResponse(f'{status}: {api_url}')
+        return self._ladder_members(data, model.League.Grandmaster, None)
+
+    async def get_ladder_members(self, server: model.Server,
+                                 realmID, profileID, ladderID):
+        """Collect the members of a ladder via one of its members.
+
+        Return their ladder data by realm and profile id.
+        """
+        api_url = (f'{self.api_url}/sc2/profile/'
+                   f'{server.id()}/{realmID}/{profileID}/ladder/{ladderID}')
+        payload = {'locale': 'en_US'}
+        data, status = await self._perform_api_request(api_url, params=payload)
+        if status != 200:
+            raise InvalidApiResponse(f'{status}: {api_url}')
+        return self._ladder_members(
+            data, model.League.get(data.get('league')), int(ladderID))
+
+    @staticmethod
+    def _ladder_members(data, league, ladder_id):
+        """Parse the 1v1 teams of a ladder by realm and profile id."""
+        members = {}
+        for team in data.get('ladderTeams', []):
+            if team.get('mmr') is None or not team.get('teamMembers'):
+                continue
+            player = team.get('teamMembers')[0]
+            key = (int(player.get('realm')), int(player.get('id')))
+            members.setdefault(key, []).append({
+                'mmr': int(team.get('mmr')),
+                'race': model.Race.get(player.get('favoriteRace', '')),
+                'games': int(team.get('wins')) + int(team.get('losses')),
+                'wins': int(team.get('wins')),
+                'losses': int(team.get('losses')),
+                'name': player.get('displayName'),
+                'joined': datetime.fromtimestamp(team.get('joinTimestamp')),
+                'ladder_id': ladder_id,
+                'league': league})
+        return members
+
+    async def get_legacy_ladder(self, server: model.Server, ladder_id):
+        """Collect the members of a (previous season's) ladder.
+
+        Return their ladder data by realm and profile id. The legacy
+        endpoint serves ladders of past seasons, but without MMR.
+        """
+        api_url = (f'{self.api_url}/sc2/legacy/'
+                   f'ladder/{server.id()}/{ladder_id}')
+        payload = {'locale': 'en_US'}
+        data, status = await self._perform_api_request(api_url, params=payload)
+        if status != 200:
+            raise InvalidApiResponse(f'{status}: {api_url}')
+
+        members = {}
+        for member in data.get('ladderMembers', []):
+            character = member.get('character', {})
+            key = (int(character.get('realm')), int(character.get('id')))
+            members.setdefault(key, []).append({
+                'race': model.Race.get(member.get('favoriteRaceP1', '')),
+                'wins': int(member.get('wins')),
+                'losses': int(member.get('losses')),
+                'name': character.get('displayName'),
+                'joined': datetime.fromtimestamp(
+                    member.get('joinTimestamp')),
+                'ladder_id': int(ladder_id)})
+        return members
+
     async def _get_ladders(self, server: model.Server,
                            realmID, profileID, scope='1v1'):
         """Collect all ladder of a scope where a player is ranked."""
-        api_url = ('https://eu.api.blizzard.com/sc2/'
+        api_url = (f'{self.api_url}/sc2/'
                    f'profile/{server.id()}/{realmID}/{profileID}/'
                    'ladder/summary')
-        payload = {'locale': 'en_US',
-                   'access_token': await self.get_access_token()}
+        payload = {'locale': 'en_US'}
         data, status = await self._perform_api_request(api_url, params=payload)
         if status != 200:
             raise InvalidApiResponse(f'{status}: {api_url}')
@@ -180,10 +357,9 @@ class SC2API:
     async def _get_metadata(self, server: model.Server,
                             realmID, profileID):
         """Collect a player's meta data."""
-        api_url = ('https://eu.api.blizzard.com/sc2/'
+        api_url = (f'{self.api_url}/sc2/'
                    f'metadata/profile/{server.id()}/{realmID}/{profileID}')
-        payload = {'locale': 'en_US',
-                   'access_token': await self.get_access_token()}
+        payload = {'locale': 'en_US'}
         data, status = await self._perform_api_request(api_url, params=payload)
         if status != 200:
             raise InvalidApiResponse(f'{status}: {api_url}')
@@ -192,10 +368,9 @@ class SC2API:
     async def _get_ladder_data(self, server: model.Server,
                                realmID, profileID, ladderID):
         """Collect data of a specific player's ladder."""
-        api_url = ('https://eu.api.blizzard.com/sc2/profile/'
+        api_url = (f'{self.api_url}/sc2/profile/'
                    f'{server.id()}/{realmID}/{profileID}/ladder/{ladderID}')
-        payload = {'locale': 'en_US',
-                   'access_token': await self.get_access_token()}
+        payload = {'locale': 'en_US'}
         data, status = await self._perform_api_request(api_url, params=payload)
         if status != 200:
             raise InvalidApiResponse(f'{status}: {api_url}')
@@ -257,10 +432,9 @@ class SC2API:
     async def _get_match_history(self, server: model.Server,
                                  realmID, profileID, scope='1v1'):
         """Collect matches of a specific scope from the match history."""
-        api_url = ('https://eu.api.blizzard.com/sc2/legacy/profile/'
+        api_url = (f'{self.api_url}/sc2/legacy/profile/'
                    f'{server.id()}/{realmID}/{profileID}/matches')
-        payload = {'locale': 'en_US',
-                   'access_token': await self.get_access_token()}
+        payload = {'locale': 'en_US'}
         data, status = await self._perform_api_request(api_url, params=payload)
         if status != 200:
             raise InvalidApiResponse(f'{status}: {api_url}')
@@ -276,71 +450,170 @@ class SC2API:
         return match_history
 
     async def _perform_api_post_request(self, url, **kwargs):
-        """Perform a generic api request (including retries)."""
-        error = ''
-        json = {}
-        max_retries = 5
-        for retries in range(max_retries):
-            async with self._session.post(url, **kwargs) as resp:
-                self.request_count += 1
-                status = resp.status
-                if resp.status == 504:
-                    error = 'API timeout'
-                    self.retry_count += 1
-                    continue
-                try:
-                    resp.raise_for_status()
-                except ClientResponseError:
-                    error = f'{resp.status}: {resp.reason}'
-                    continue
-                try:
-                    json = await resp.json()
-                except ContentTypeError:
-                    error = 'Unable to decode JSON'
-                    self.retry_count += 1
-                    status = 0
-                    continue
-                json['request_datetime'] = datetime.now()
-                break
-
-        if retries == max_retries - 1 and error:
-            logger.warning(error)
-
-        return json, status
+        """Perform a generic api post request (including retries)."""
+        return await self._perform_request('POST', url, **kwargs)
 
     async def _perform_api_request(self, url, **kwargs):
-        """Perform a generic api request (including retries)."""
+        """Perform a generic api request (including retries).
+
+        Concurrent identical requests share a single request and its
+        result.
+        """
+        key = request_key('GET', url, kwargs.get('params'))
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced_count += 1
+        else:
+            task = asyncio.ensure_future(
+                self._perform_request('GET', url, authenticate=True,
+                                      **kwargs))
+            self._in_flight[key] = task
+
+            def done(task):
+                self._in_flight.pop(key, None)
+                # All callers may have been cancelled, e.g. if a pipeline
+                # stage failed, and nobody would retrieve the exception.
+                if not task.cancelled():
+                    task.exception()
+
+            task.add_done_callback(done)
+        # Shielded, so that a cancelled caller does not cancel the others.
+        return await asyncio.shield(task)
+
+    async def _perform_request(self, method, url, authenticate=False,
+                               **kwargs):
+        """Perform a request via the transport (including retries).
+
+        Authenticated requests are made with the access token of the least
+        loaded credentials and limited by the concurrency limiter.
+        Raise CircuitOpenError if the circuit breaker of the region and
+        endpoint rejects the request.
+        """
         error = ''
         json = {}
         max_retries = 5
+        family = endpoint_family(url)
+        region = endpoint_region(url)
+        breaker = None
+        if region is not None and self.breakers.enabled:
+            breaker = self.breakers.get(region, family)
         for retries in range(max_retries):
-            async with self._session.get(url, **kwargs) as resp:
-                self.request_count += 1
-                status = resp.status
-                if resp.status == 504:
-                    error = 'API timeout'
-                    self.retry_count += 1
-                    continue
-                try:
-                    resp.raise_for_status()
-                except ClientResponseError:
-                    error = f'{resp.status}: {resp.reason}'
-                    continue
+            credential = None
+            if authenticate:
+                credential = await self.credentials.acquire()
+            limited = False
+            probe = False
+            resp = None
+            start = None
+            try:
+                if credential is not None:
+                    kwargs['params'] = dict(
+                        kwargs.get('params') or {},
+                        access_token=await self.get_access_token(
+                            credential))
+                if authenticate and self.limiter.enabled:
+                    with self.metrics.timer('http', 'limiter_wait'):
+                        await self.limiter.acquire()
+                    limited = True
+                # Checked last, so that the probe is actually made.
+                if breaker is not None:
+                    if not breaker.allow():
+                        raise CircuitOpenError(
+                            f'Circuit breaker {breaker.name} is open: {url}')
+                    probe = breaker.state != CLOSED
+                start = time.perf_counter()
                 try:
-                    json = await resp.json()
-                except ContentTypeError:
-                    error = 'Unable to decode JSON'
-                    self.retry_count += 1
-                    status = 0
-                    continue
-                json['request_datetime'] = datetime.now()
-                break
+                    with self.metrics.endpoint(family):
+                        resp = await self.transport.request(
+                            method, url, **kwargs)
+                except Exception as exc:
+                    if breaker is not None:
+                        breaker.record(False, probe)
+                        probe = False
+                    if limited:
+                        self._record_limit(
+                            isinstance(exc, asyncio.TimeoutError))
+                    raise
+            finally:
+                if probe and resp is None:
+                    breaker.abandon_probe()
+                if limited:
+                    self.limiter.release()
+                if credential is not None:
+                    if start is None:
+                        self.credentials.release(credential)
+                    else:
+                        self._release_credential(
+                            credential, resp, time.perf_counter() - start)
+            self.request_count += 1
+            status = resp.status
+            if limited:
+                self._record_limit(status in (429, 504),
+                                   time.perf_counter() - start)
+            if breaker is not None:
+                breaker.record(resp.status < 500 and resp.status != 429
+                               and (resp.status >= 400
+                                    or resp.data is not None), probe)
+            if resp.status == 504:
+                error = 'API timeout'
+                self.retry_count += 1
+                continue
+            if resp.status == 401 and credential is not None:
+                error = f'{resp.status}: {resp.reason}'
+                self.retry_count += 1
+                self.drop_access_token(
+                    credential, kwargs['params']['access_token'])
+                continue
+            if resp.status >= 400:
+                error = f'{resp.status}: {resp.reason}'
+                continue
+            if resp.data is None:
+                error = 'Unable to decode JSON'
+                self.retry_count += 1
+                status = 0
+                continue
+            json = resp.data
+            json['request_datetime'] = datetime.now()
+            break
 
         if retries == max_retries - 1 and error:
             logger.warning(error)
 
         return json, status
 
+    def _release_credential(self, credential, resp, seconds):
+        """Release credentials and record their request to the metrics."""
+        throttled = resp is not None and resp.status == 429
+        self.credentials.release(credential, throttled)
+        if self.metrics.enabled:
+            self.metrics.record('credential', credential.name, seconds)
+            if throttled:
+                self.metrics.record('credential',
+                                    f'{credential.name}:throttled', seconds)
+
+    def _record_limit(self, overloaded, latency=None):
+        """Adjust the concurrency limit by the outcome of a request."""
+        if (self.limiter.record(overloaded, latency)
+                and self.metrics.enabled):
+            self.metrics.record('http', 'concurrency_limit',
+                                self.limiter.current)
+
+    async def close(self):
+        """Stop the token refresh and requests and close the transport."""
+        for credential in self.credentials:
+            if credential.refresh_task is not None:
+                credential.refresh_task.cancel()
+                try:
+                    await credential.refresh_task
+                except asyncio.CancelledError:
+                    pass
+                credential.refresh_task = None
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.transport.close()
+
 
 class InvalidApiResponse(Exception):
     """Invalid API Response exception."""
@@ -0,0 +1,158 @@
+"""Count SQL statements per run and player via SQLAlchemy engine events."""
+import contextvars
+import re
+import time
+
+from sqlalchemy import event
+
+import sc2monitor.model as model
+
+current_player = contextvars.ContextVar('current_player', default=None)
+
+_LITERALS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def fingerprint(statement):
+    """Return the statement with all literals and parameters replaced."""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class StatementStats:
+    """Aggregated executions of a statement fingerprint."""
+
+    __slots__ = ('count', 'rows', 'total', 'max_per_player',
+                 'flagged_players')
+
+    def __init__(self):
+        """Init the statistics without executions."""
+        self.count = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max_per_player = 0
+        self.flagged_players = 0
+
+
+class SQLStatistics:
+    """Count statements, rows and time by fingerprint per run and player.
+
+    The player a statement belongs to is taken from the context variable
+    `current_player`, which is set for each task querying a player. If a
+    fingerprint is executed at least `threshold` times while a single
+    player is processed, it is flagged as likely N+1 pattern.
+    """
+
+    def __init__(self, threshold=5, enabled=True):
+        """Init the statistics."""
+        self.threshold = threshold
+        self.enabled = enabled
+        self.engine = None
+        self._fingerprints = {}
+        self.reset()
+
+    def reset(self):
+        """Remove all collected statistics."""
+        self.statements = {}
+        self.players = {}
+        self.count = 0
+        self.total = 0.0
+
+    def attach(self, engine):
+        """Listen to the statement executions of an engine."""
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def detach(self):
+        """Stop listening to the engine."""
+        if self.engine is None:
+            return
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_execute)
+        event.remove(self.engine, 'after_cursor_execute',
+                     self._after_execute)
+        self.engine = None
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        if self.enabled:
+            conn.info.setdefault('sqlstats_start', []).append(
+                time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        if not self.enabled:
+            return
+        try:
+            elapsed = time.perf_counter() - conn.info['sqlstats_start'].pop()
+        except (KeyError, IndexError):
+            elapsed = 0.0
+        try:
+            key = self._fingerprints[statement]
+        except KeyError:
+            key = fingerprint(statement)
+            self._fingerprints[statement] = key
+        try:
+            stats = self.statements[key]
+        except KeyError:
+            stats = StatementStats()
+            self.statements[key] = stats
+        stats.count += 1
+        stats.rows += max(cursor.rowcount, 0)
+        stats.total += elapsed
+        self.count += 1
+        self.total += elapsed
+
+        player = current_player.get()
+        if player is not None:
+            counts = self.players.setdefault(player, {})
+            counts[key] = counts.get(key, 0) + 1
+
+    def finish_player(self, player):
+        """Aggregate and forget the statements of a processed player."""
+        for key, count in self.players.pop(player, {}).items():
+            stats = self.statements[key]
+            if count > stats.max_per_player:
+                stats.max_per_player = count
+            if count >= self.threshold:
+                stats.flagged_players += 1
+
+    def n_plus_one(self):
+        """Return the fingerprints flagged as likely N+1 patterns."""
+        return [key for key, stats in self.statements.items()
+                if stats.flagged_players > 0]
+
+    def to_models(self, top=10):
+        """Return the top offenders as RunStatement database entries.
+
+        These are the statements with the most time spent and every
+        statement flagged as likely N+1 pattern (limited to `top` each).
+        """
+        for player in list(self.players):
+            self.finish_player(player)
+        by_time = sorted(self.statements.items(),
+                         key=lambda item: item[1].total, reverse=True)
+        flagged = sorted(((key, stats) for key, stats in by_time
+                          if stats.flagged_players > 0),
+                         key=lambda item: item[1].max_per_player,
+                         reverse=True)
+        selected = dict(by_time[:top])
+        selected.update(flagged[:top])
+        return [model.RunStatement(
+            fingerprint=key[:1024],
+            count=stats.count,
+            rows=stats.rows,
+            total=stats.total,
+            max_per_player=stats.max_per_player,
+            flagged_players=stats.flagged_players,
+            n_plus_one=stats.flagged_players > 0)
+            for key, stats in sorted(selected.items(),
+                                     key=lambda item: item[1].total,
+                                     reverse=True)]
@@ -0,0 +1,90 @@
+"""Export spans of a run in the Chrome trace event format."""
+import json
+import os
+import time
+
+from sqlalchemy import event
+
+from sc2monitor.sqlstats import current_player
+
+
+class Tracer:
+    """Collect spans tagged with the processed player.
+
+    Each player is shown as its own thread in a trace viewer (e.g.
+    chrome://tracing or Perfetto), spans outside of a player's
+    processing are shown as thread `run`.
+    """
+
+    def __init__(self, enabled=False):
+        """Init the tracer without any spans."""
+        self.enabled = enabled
+        self.session = None
+        self.reset()
+
+    def reset(self):
+        """Remove all spans and restart the clock."""
+        self.events = []
+        self.players = set()
+        self._origin = time.perf_counter()
+        self._commits = {}
+
+    def add(self, category, name, start, end):
+        """Add a span between two perf_counter values."""
+        player = current_player.get()
+        tid = player if player is not None else 0
+        self.players.add(tid)
+        self.events.append({'name': name,
+                            'cat': category,
+                            'ph': 'X',
+                            'ts': (start - self._origin) * 1e6,
+                            'dur': (end - start) * 1e6,
+                            'pid': 1,
+                            'tid': tid})
+
+    def attach(self, session):
+        """Trace the commits of a database session."""
+        self.session = session
+        event.listen(session, 'before_commit', self._before_commit)
+        event.listen(session, 'after_commit', self._after_commit)
+        event.listen(session, 'after_rollback', self._after_rollback)
+
+    def detach(self):
+        """Stop tracing the commits of the database session."""
+        if self.session is None:
+            return
+        event.remove(self.session, 'before_commit', self._before_commit)
+        event.remove(self.session, 'after_commit', self._after_commit)
+        event.remove(self.session, 'after_rollback', self._after_rollback)
+        self.session = None
+
+    def _before_commit(self, session):
+        if self.enabled:
+            self._commits[id(session)] = time.perf_counter()
+
+    def _after_commit(self, session):
+        start = self._commits.pop(id(session), None)
+        if start is not None:
+            self.add('db', 'commit', start, time.perf_counter())
+
+    def _after_rollback(self, session):
+        self._commits.pop(id(session), None)
+
+    def trace(self):
+        """Return the spans as Chrome trace event dictionary."""
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+                     'args': {'name': 'sc2monitor'}}]
+        for tid in sorted(self.players):
+            metadata.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                'args': {'name': f'player {tid}' if tid else 'run'}})
+        return {'traceEvents': metadata + self.events,
+                'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        """Write the spans as Chrome trace event JSON file."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.trace(), file, separators=(',', ':'))
@@ -0,0 +1,209 @@
+"""Pluggable transports performing the HTTP requests of the SC2 api."""
+import asyncio
+import gzip
+import json
+import logging
+import re
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+SECRET_PARAMS = ('access_token', 'token')
+REPLAY_TOKEN = 'replay-access-token'
+
+ENDPOINT_FAMILIES = (
+    (re.compile(r'/oauth/token$'), 'oauth_token'),
+    (re.compile(r'/oauth/check_token$'), 'check_token'),
+    (re.compile(r'/sc2/ladder/season/\d+$'), 'season'),
+    (re.compile(r'/sc2/profile/\d+/\d+/\d+/ladder/summary$'),
+     'ladder_summary'),
+    (re.compile(r'/sc2/profile/\d+/\d+/\d+/ladder/\d+$'), 'ladder'),
+    (re.compile(r'/sc2/metadata/profile/\d+/\d+/\d+$'), 'metadata'),
+    (re.compile(r'/sc2/legacy/profile/\d+/\d+/\d+/matches$'),
+     'match_history'),
+    (re.compile(r'/sc2/legacy/ladder/\d+/\d+$'), 'legacy_ladder'),
+    (re.compile(r'/sc2/ladder/grandmaster/\d+$'), 'grandmaster_ladder'),
+)
+
+REGION_PATTERN = re.compile(
+    r'/sc2/(?:legacy/|metadata/)?'
+    r'(?:profile|ladder/season|ladder/grandmaster|ladder)/(\d+)/')
+
+
+def endpoint_family(url):
+    """Return the name of the api endpoint family of an url."""
+    for pattern, family in ENDPOINT_FAMILIES:
+        if pattern.search(url):
+            return family
+    return 'other'
+
+
+def endpoint_region(url):
+    """Return the region id of an api url or None."""
+    match = REGION_PATTERN.search(url + '/')
+    return int(match.group(1)) if match else None
+
+
+class TransportResponse:
+    """Status, reason and decoded JSON data of a response."""
+
+    def __init__(self, status, reason='', data=None):
+        """Init the response; data is None if it could not be decoded."""
+        self.status = status
+        self.reason = reason
+        self.data = data
+
+    def __repr__(self):
+        """Represent the response."""
+        return (f'<TransportResponse(status={self.status}, '
+                f'reason={self.reason})>')
+
+
+def request_key(method, url, params=None):
+    """Return the key identifying a request without any secrets."""
+    params = sorted((str(key), str(value))
+                    for key, value in (params or {}).items()
+                    if key not in SECRET_PARAMS)
+    return method.upper(), url, tuple(params)
+
+
+class HTTPTransport:
+    """Transport performing the requests via an aiohttp session.
+
+    If metrics are given, the time needed to decode the JSON responses is
+    recorded per endpoint family.
+    """
+
+    def __init__(self, session, metrics=None):
+        """Init the transport with an aiohttp client session."""
+        self._session = session
+        self._metrics = metrics
+
+    async def request(self, method, url, **kwargs):
+        """Perform a request and decode its JSON body if successful."""
+        async with self._session.request(method, url, **kwargs) as resp:
+            data = None
+            if resp.status < 400:
+                body = await resp.read()
+                if 'json' in resp.content_type:
+                    start = time.perf_counter()
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        data = None
+                    if self._metrics is not None and self._metrics.enabled:
+                        self._metrics.record(
+                            'http', f'decode:{endpoint_family(url)}',
+                            time.perf_counter() - start)
+            return TransportResponse(resp.status, resp.reason, data)
+
+    async def close(self):
+        """Close the transport (the session is owned by the controller)."""
+
+
+class RecordingTransport:
+    """Transport recording the responses of another transport.
+
+    The exchanges are written as gzip compressed JSON lines to `path`
+    on close. Access tokens are neither part of the request keys nor of
+    the recorded oauth responses.
+    """
+
+    def __init__(self, transport, path):
+        """Init the transport wrapping another transport."""
+        self._transport = transport
+        self.path = path
+        self.entries = []
+        self._start = time.time()
+
+    async def request(self, method, url, **kwargs):
+        """Perform and record a request."""
+        started = time.time()
+        response = await self._transport.request(method, url, **kwargs)
+        elapsed = time.time() - started
+        data = response.data
+        if data is not None and 'access_token' in data:
+            data = dict(data, access_token=REPLAY_TOKEN)
+        method, url, params = request_key(
+            method, url, kwargs.get('params'))
+        self.entries.append({
+            'method': method,
+            'url': url,
+            'params': params,
+            'status': response.status,
+            'reason': response.reason,
+            # Serialize right away as the caller may alter the data.
+            'data': json.dumps(data),
+            'time': started,
+            'offset': started - self._start,
+            'elapsed': elapsed})
+        return response
+
+    def save(self):
+        """Write the recorded exchanges to the archive."""
+        self.entries.sort(key=lambda entry: entry['offset'])
+        with gzip.open(self.path, 'wt', encoding='utf-8') as archive:
+            archive.write(json.dumps({'version': ARCHIVE_VERSION,
+                                      'recorded': self._start,
+                                      'requests': len(self.entries)}))
+            archive.write('\n')
+            for entry in self.entries:
+                archive.write(json.dumps(entry, separators=(',', ':')))
+                archive.write('\n')
+        logger.info(f'Recorded {len(self.entries)} api responses'
+                    f' to {self.path}.')
+
+    async def close(self):
+        """Save the archive and close the wrapped transport."""
+        self.save()
+        await self._transport.close()
+
+
+class ReplayTransport:
+    """Transport serving recorded responses without any network access.
+
+    Identical requests are answered in recorded order, the last response
+    is repeated once they are exhausted. Each response is delayed by its
+    recorded duration multiplied by `speed` (0 disables the delays).
+    """
+
+    def __init__(self, path, speed=1.0):
+        """Load an archive written by the RecordingTransport."""
+        self.path = path
+        self.speed = float(speed)
+        self.responses = {}
+        self.misses = 0
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            header = json.loads(archive.readline())
+            if header.get('version') != ARCHIVE_VERSION:
+                raise ValueError(
+                    f"Unsupported archive version {header.get('version')}")
+            for line in archive:
+                entry = json.loads(line)
+                key = request_key(entry['method'], entry['url'],
+                                  dict(entry['params']))
+                self.responses.setdefault(key, deque()).append(entry)
+
+    async def request(self, method, url, **kwargs):
+        """Serve a recorded response."""
+        key = request_key(method, url, kwargs.get('params'))
+        entries = self.responses.get(key)
+        if not entries:
+            self.misses += 1
+            logger.debug(f'No recorded response for {method} {url}')
+            return TransportResponse(404, 'Not recorded')
+        entry = entries.popleft() if len(entries) > 1 else entries[0]
+        if self.speed > 0.0:
+            await asyncio.sleep(entry['elapsed'] * self.speed)
+        data = json.loads(entry['data'])
+        if (data is not None and 'exp' in data
+                and urlsplit(url).path.endswith('/check_token')):
+            # Shift the token expiry as if it was checked just now.
+            data['exp'] += int(time.time() - entry['time'])
+        return TransportResponse(entry['status'], entry['reason'], data)
+
+    async def close(self):
+        """Close the transport."""
@@ -0,0 +1,151 @@
+"""Benchmark the throughput of Controller.run against the offline fake api.
+
+Each player count is benchmarked in a fresh process. The peak memory is
+the maximum resident set size of that process unless `--tracemalloc` is
+given, which reports the peak of Python allocations per run instead, but
+slows down the runs considerably.
+
+Example:
+    python test/benchmark.py --players 100 1000 10000 --latency 0.05
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from fakeapi import FakeBlizzardAPI
+from sqlalchemy import event
+
+import sc2monitor.model as model
+from sc2monitor.controller import Controller
+
+
+class RunStats:
+    """Measurements of a single benchmarked run."""
+
+    def __init__(self, label, players, duration, requests, commits, peak):
+        """Init the measurements."""
+        self.label = label
+        self.players = players
+        self.duration = duration
+        self.requests = requests
+        self.commits = commits
+        self.peak = peak
+
+    def __str__(self):
+        """Format the measurements as table row."""
+        return (f'{self.label:>10} {self.players:>8} {self.duration:>9.2f}'
+                f' {self.players / self.duration:>11.1f}'
+                f' {self.requests:>9} {self.commits:>8}'
+                f' {self.peak / 2**20:>9.1f}')
+
+
+HEADER = (f"{'run':>10} {'players':>8} {'seconds':>9} {'players/s':>11}"
+          f" {'requests':>9} {'commits':>8} {'peak MiB':>9}")
+
+
+def max_rss():
+    """Return the maximum resident set size of the process in bytes."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def measure(ctrl, label, players, commits, trace_memory=False):
+    """Run the controller once and collect its measurements."""
+    requests = ctrl.sc2api.request_count
+    commits_before = commits[0]
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await ctrl.run()
+    duration = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = max_rss()
+    return RunStats(label, players, duration,
+                    ctrl.sc2api.request_count - requests,
+                    commits[0] - commits_before, peak)
+
+
+async def benchmark(players, runs, db, trace_memory=False,
+                    sqlite_profile=False, **fake_kwargs):
+    """Benchmark an initial and several follow-up runs."""
+    results = []
+    async with FakeBlizzardAPI(players=players, **fake_kwargs) as api:
+        async with Controller(db=db, sqlite_profile=sqlite_profile) as ctrl:
+            api.patch(ctrl.sc2api)
+            ctrl.db_session.bulk_save_objects([
+                model.Player(player_id=account.profile_id,
+                             realm=account.realm,
+                             server=model.Server(account.region))
+                for account in api.accounts.values()])
+            ctrl.db_session.commit()
+
+            commits = [0]
+
+            def count_commit(session):
+                commits[0] += 1
+
+            event.listen(ctrl.db_session, 'after_commit', count_commit)
+
+            results.append(await measure(
+                ctrl, 'initial', players, commits, trace_memory))
+            for idx in range(runs):
+                api.advance()
+                results.append(await measure(
+                    ctrl, f'update {idx + 1}', players, commits,
+                    trace_memory))
+    return results
+
+
+def benchmark_process(players, args):
+    """Benchmark a player count with a temporary database."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = args.db or 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        return asyncio.run(benchmark(
+            players, args.runs, db,
+            trace_memory=args.tracemalloc,
+            sqlite_profile=args.sqlite_profile,
+            latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate))
+
+
+def main():
+    """Parse the arguments and run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--runs', type=int, default=2,
+                        help='follow-up runs after the initial run')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--db', default='',
+                        help='database url (default: temporary sqlite file)')
+    parser.add_argument('--sqlite-profile', action='store_true',
+                        help='enable the sqlite performance profile')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='report peak of python allocations per run')
+    args = parser.parse_args()
+
+    print(HEADER, flush=True)
+    context = multiprocessing.get_context('spawn')
+    for players in args.players:
+        with context.Pool(1) as pool:
+            for stats in pool.apply(benchmark_process, (players, args)):
+                print(stats, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Benchmark the import time and the startup of short CLI operations.
+
+Every measurement runs in a fresh interpreter and the median of
+`--repeat` runs is reported.
+
+Example:
+    python test/benchmark_startup.py --repeat 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+URL = 'https://starcraft2.com/en-gb/profile/2/1/221986'
+
+SNIPPETS = [
+    ('python', 'pass'),
+    ('import sc2monitor', 'import sc2monitor'),
+    ('import controller', 'import sc2monitor.controller'),
+    ('add_player',
+     'from sc2monitor.controller import Controller\n'
+     'Controller(db={db!r}).add_player({url!r})'),
+    ('remove_player',
+     'from sc2monitor.controller import Controller\n'
+     'Controller(db={db!r}).remove_player({url!r})'),
+]
+
+
+def measure(code, repeat):
+    """Return the median wall time of running code in a new interpreter."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    """Parse the arguments and run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default='',
+                        help='database url (default: temporary sqlite file)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = args.db or 'sqlite:///' + os.path.join(tmp, 'startup.db')
+        # Create the schema once, so that only the startup is measured.
+        subprocess.run([sys.executable, '-c', SNIPPETS[3][1].format(
+            db=db, url=URL)], check=True)
+        print(f"{'operation':>18} {'median ms':>10}")
+        for label, code in SNIPPETS:
+            duration = measure(code.format(db=db, url=URL), args.repeat)
+            print(f'{label:>18} {duration * 1000:>10.1f}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""Offline fake of the Blizzard endpoints used by the sc2monitor."""
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import BasicAuth, web
+from aiohttp.test_utils import TestServer
+
+RACES = ['Protoss', 'Terran', 'Zerg', 'Random']
+LEAGUES = [(5000, 'GRANDMASTER'), (4500, 'MASTER'), (3800, 'DIAMOND'),
+           (3200, 'PLATINUM'), (2700, 'GOLD'), (2200, 'SILVER'),
+           (0, 'BRONZE')]
+
+
+class FakeAccount:
+    """Synthetic 1v1 ladder account of the fake api."""
+
+    def __init__(self, region, realm, profile_id, name, race, mmr):
+        """Init the account without any games played."""
+        self.region = region
+        self.realm = realm
+        self.profile_id = profile_id
+        self.name = name
+        self.race = race
+        self.mmr = mmr
+        self.wins = 0
+        self.losses = 0
+        self.ladder_id = 0
+        self.joined = 0
+        self.matches = []
+
+    def url(self):
+        """Return the starcraft2.com profile url of the account."""
+        return (f'https://starcraft2.com/en-gb/profile/'
+                f'{self.region}/{self.realm}/{self.profile_id}')
+
+
+class FakeBlizzardAPI:
+    """Local aiohttp fake of the Blizzard oauth and SC2 endpoints.
+
+    The fake serves synthetic ladders of `players` accounts spread over
+    `regions`, grouped in ladders of `ladder_size` by MMR. Every request
+    besides the oauth ones sleeps `latency` (plus up to `jitter`) seconds
+    and fails with `error_status` with probability `error_rate`, optionally
+    only for the regions in `error_regions`. If more than `capacity`
+    requests are in flight, further requests are throttled (429). Every
+    api client gets its own access token, the requests of clients in
+    `throttled_clients` are throttled.
+    """
+
+    season_id = 50
+
+    def __init__(self, players=100, regions=(1, 2, 3), ladder_size=100,
+                 latency=0.0, jitter=0.0, error_rate=0.0, error_status=504,
+                 error_regions=None, capacity=None, seed=0):
+        """Generate the synthetic ladders."""
+        self.latency = latency
+        self.capacity = capacity
+        self.in_flight = 0
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_regions = error_regions
+        self.requests = Counter()
+        self.server = None
+        self.url = ''
+        self.token = 'fake-access-token'
+        self.tokens = {}
+        self.client_requests = Counter()
+        self.throttled_clients = set()
+        self._random = random.Random(seed)
+        self._clock = int(time.time()) - 7 * 24 * 3600
+        self.season_start = self._clock - 24 * 3600
+        self.season_end = int(time.time()) + 60 * 24 * 3600
+        self.accounts = {}
+        self.ladders = {}
+        self.legacy_ladders = {}
+
+        for idx in range(players):
+            account = FakeAccount(
+                region=regions[idx % len(regions)],
+                realm=1,
+                profile_id=100000 + idx,
+                name=f'Fake{idx}',
+                race=self._random.choice(RACES),
+                mmr=self._random.randint(1500, 6500))
+            self.accounts[self._key(account.region, account.realm,
+                                    account.profile_id)] = account
+
+        for region in regions:
+            members = sorted(
+                (account for account in self.accounts.values()
+                 if account.region == region),
+                key=lambda account: account.mmr, reverse=True)
+            for start in range(0, len(members), ladder_size):
+                ladder_id = 200000 + len(self.ladders)
+                ladder = members[start:start + ladder_size]
+                for account in ladder:
+                    account.ladder_id = ladder_id
+                    account.joined = self.season_start
+                self.ladders[ladder_id] = ladder
+
+        self.advance(activity=1.0)
+
+    @staticmethod
+    def _key(region, realm, profile_id):
+        return int(region), int(realm), int(profile_id)
+
+    @staticmethod
+    def league(mmr):
+        """Return the league name of a MMR value."""
+        for min_mmr, league in LEAGUES:
+            if mmr >= min_mmr:
+                return league
+        return LEAGUES[-1][1]
+
+    def advance(self, activity=0.5, max_games=3):
+        """Let a share of the accounts play some games."""
+        self._clock += 3600
+        for account in self.accounts.values():
+            if self._random.random() >= activity:
+                continue
+            for _ in range(self._random.randint(1, max_games)):
+                self._clock += 1
+                win = self._random.random() < 0.5
+                if win:
+                    account.wins += 1
+                    account.mmr += 20
+                else:
+                    account.losses += 1
+                    account.mmr -= 20
+                account.matches.insert(0, {
+                    'map': 'Fake LE',
+                    'type': '1v1',
+                    'decision': 'WIN' if win else 'LOSS',
+                    'speed': 'FASTER',
+                    'date': self._clock})
+            del account.matches[25:]
+
+    def new_season(self):
+        """Start a new season, moving the accounts to new ladders.
+
+        The final standings of the previous season's ladders stay
+        available via the legacy ladder endpoint.
+        """
+        self._clock += 3600
+        for ladder_id, ladder in self.ladders.items():
+            self.legacy_ladders[ladder_id] = [{
+                'character': {'id': str(member.profile_id),
+                              'realm': member.realm,
+                              'region': member.region,
+                              'displayName': member.name,
+                              'clanName': '',
+                              'clanTag': '',
+                              'profilePath': (f'/profile/{member.region}/'
+                                              f'{member.realm}/'
+                                              f'{member.profile_id}')},
+                'joinTimestamp': member.joined,
+                'points': member.wins * 10,
+                'wins': member.wins,
+                'losses': member.losses,
+                'highestRank': 1,
+                'previousRank': 0,
+                'favoriteRaceP1': member.race.upper()} for member in ladder]
+        self.season_id += 1
+        self.season_start = self._clock
+        ladders, self.ladders = self.ladders, {}
+        offset = 200000 + len(self.legacy_ladders)
+        for idx, ladder in enumerate(ladders.values()):
+            for account in ladder:
+                account.ladder_id = offset + idx
+                account.joined = self.season_start
+                account.wins = 0
+                account.losses = 0
+            self.ladders[offset + idx] = ladder
+
+    async def __aenter__(self):
+        """Start serving the fake api on a local port."""
+        app = web.Application()
+        app.router.add_post('/oauth/token', self.handle_token)
+        app.router.add_get('/oauth/check_token', self.handle_check_token)
+        app.router.add_get('/sc2/ladder/season/{region}', self.handle_season)
+        app.router.add_get('/sc2/ladder/grandmaster/{region}',
+                           self.handle_grandmaster)
+        app.router.add_get(
+            '/sc2/profile/{region}/{realm}/{profile}/ladder/summary',
+            self.handle_ladder_summary)
+        app.router.add_get(
+            '/sc2/profile/{region}/{realm}/{profile}/ladder/{ladder}',
+            self.handle_ladder)
+        app.router.add_get(
+            '/sc2/metadata/profile/{region}/{realm}/{profile}',
+            self.handle_metadata)
+        app.router.add_get(
+            '/sc2/legacy/profile/{region}/{realm}/{profile}/matches',
+            self.handle_match_history)
+        app.router.add_get(
+            '/sc2/legacy/ladder/{region}/{ladder}',
+            self.handle_legacy_ladder)
+        self.server = TestServer(app, host='127.0.0.1', access_log=None)
+        await self.server.start_server()
+        self.url = str(self.server.make_url('')).rstrip('/')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """Stop serving the fake api."""
+        await self.server.close()
+
+    def patch(self, sc2api):
+        """Point a SC2API instance to the fake."""
+        sc2api.api_url = self.url
+        sc2api.oauth_url = self.url
+
+    async def _simulate(self, endpoint, region=None):
+        """Count the request and inject latency and errors.
+
+        Return an error response if an error is injected.
+        """
+        self.requests[endpoint] += 1
+        if self.capacity is not None and self.in_flight >= self.capacity:
+            self.requests['throttled'] += 1
+            return web.json_response(
+                {'code': 429, 'type': 'Too many requests'}, status=429)
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(0.0, self.jitter)
+        if delay > 0.0:
+            self.in_flight += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.in_flight -= 1
+        if (self.error_rate > 0.0
+                and (self.error_regions is None
+                     or int(region) in self.error_regions)
+                and self._random.random() < self.error_rate):
+            self.requests['errors'] += 1
+            return web.json_response(
+                {'code': self.error_status, 'type': 'Injected error'},
+                status=self.error_status)
+        return None
+
+    def _account(self, request):
+        try:
+            return self.accounts[self._key(
+                request.match_info['region'],
+                request.match_info['realm'],
+                request.match_info['profile'])]
+        except (KeyError, ValueError):
+            raise web.HTTPNotFound()
+
+    def _check_auth(self, request):
+        try:
+            client = self.tokens[request.query.get('access_token')]
+        except KeyError:
+            raise web.HTTPUnauthorized()
+        self.client_requests[client] += 1
+        if client in self.throttled_clients:
+            self.requests['throttled'] += 1
+            raise web.HTTPTooManyRequests()
+
+    async def handle_token(self, request):
+        """Serve oauth/token."""
+        self.requests['token'] += 1
+        try:
+            client = BasicAuth.decode(request.headers['Authorization']).login
+        except (KeyError, ValueError):
+            raise web.HTTPUnauthorized()
+        token = f'{self.token}-{client}' if client else self.token
+        self.tokens[token] = client
+        return web.json_response({'access_token': token,
+                                  'token_type': 'bearer',
+                                  'expires_in': 86399})
+
+    async def handle_check_token(self, request):
+        """Serve oauth/check_token."""
+        self.requests['check_token'] += 1
+        if request.query.get('token') not in self.tokens:
+            raise web.HTTPBadRequest()
+        return web.json_response({'exp': int(time.time()) + 86399,
+                                  'client_id': 'fake'})
+
+    async def handle_season(self, request):
+        """Serve the current season of a region."""
+        region = request.match_info['region']
+        error = await self._simulate('season', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        return web.json_response({'seasonId': self.season_id,
+                                  'number': 2,
+                                  'year': 2022,
+                                  'startDate': str(self.season_start),
+                                  'endDate': str(self.season_end)})
+
+    async def handle_ladder_summary(self, request):
+        """Serve the ladder summary of a profile."""
+        region = request.match_info['region']
+        error = await self._simulate('ladder_summary', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        account = self._account(request)
+        return web.json_response({
+            'showCaseEntries': [],
+            'placementMatches': [],
+            'allLadderMemberships': [{
+                'ladderId': str(account.ladder_id),
+                'localizedGameMode': f'1v1 {self.league(account.mmr)}',
+                'rank': 1}]})
+
+    async def handle_ladder(self, request):
+        """Serve a ladder of a profile."""
+        region = request.match_info['region']
+        error = await self._simulate('ladder', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        account = self._account(request)
+        ladder = self.ladders.get(int(request.match_info['ladder']))
+        if ladder is None or account not in ladder:
+            raise web.HTTPNotFound()
+        ladder = sorted(ladder, key=lambda member: member.mmr, reverse=True)
+        teams = self._teams(ladder)
+        rank = ladder.index(account) + 1
+        return web.json_response({
+            'ladderTeams': teams,
+            'allLadderMemberships': [],
+            'ranksAndPools': [{'rank': rank,
+                               'mmr': account.mmr,
+                               'bonusPool': 0}],
+            'league': self.league(ladder[0].mmr)})
+
+    async def handle_grandmaster(self, request):
+        """Serve the grandmaster ladder of a region."""
+        region = request.match_info['region']
+        error = await self._simulate('grandmaster_ladder', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        members = [member for ladder in self.ladders.values()
+                   if self.league(ladder[0].mmr) == 'GRANDMASTER'
+                   for member in ladder if member.region == int(region)]
+        members.sort(key=lambda member: member.mmr, reverse=True)
+        return web.json_response({'ladderTeams': self._teams(members)})
+
+    @staticmethod
+    def _teams(members):
+        return [{
+            'teamMembers': [{'id': str(member.profile_id),
+                             'realm': member.realm,
+                             'region': member.region,
+                             'displayName': member.name,
+                             'favoriteRace': member.race.lower()}],
+            'previousRank': 0,
+            'points': member.wins * 10,
+            'wins': member.wins,
+            'losses': member.losses,
+            'mmr': member.mmr,
+            'joinTimestamp': member.joined} for member in members]
+
+    async def handle_metadata(self, request):
+        """Serve the metadata of a profile."""
+        region = request.match_info['region']
+        error = await self._simulate('metadata', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        account = self._account(request)
+        return web.json_response({
+            'name': account.name,
+            'profileUrl': account.url(),
+            'avatarUrl': '',
+            'regionId': account.region,
+            'realmId': account.realm,
+            'profileId': str(account.profile_id)})
+
+    async def handle_match_history(self, request):
+        """Serve the legacy match history of a profile."""
+        region = request.match_info['region']
+        error = await self._simulate('match_history', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        account = self._account(request)
+        return web.json_response({'matches': account.matches})
+
+    async def handle_legacy_ladder(self, request):
+        """Serve a ladder of the previous season."""
+        region = request.match_info['region']
+        error = await self._simulate('legacy_ladder', region)
+        if error is not None:
+            return error
+        self._check_auth(request)
+        try:
+            members = self.legacy_ladders[int(request.match_info['ladder'])]
+        except (KeyError, ValueError):
+            raise web.HTTPNotFound()
+        return web.json_response({'ladderMembers': members})
@@ -0,0 +1,124 @@
+"""Test the sc2monitor controller without the api."""
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import event
+
+import sc2monitor.model as model
+from sc2monitor.controller import Controller
+from sc2monitor.model import Leaderboard, Player, Race, Server, Statistics
+
+
+@pytest.fixture
+def ctrl():
+    """Return a controller with an in-memory database."""
+    controller = Controller(db='sqlite://')
+    controller.create_db_session()
+    yield controller
+    controller.close_db_session()
+
+
+def add_ranked_player(ctrl, player_id, mmr, race=Race.Zerg,
+                      server=Server.Europe):
+    player = Player(player_id=player_id, server=server, race=race,
+                    name=f'Player{player_id}', mmr=mmr, wins=3, losses=1)
+    ctrl.db_session.add(player)
+    ctrl.db_session.add(Statistics(player=player, lr_mmr_slope=1.5))
+    ctrl.db_session.commit()
+    return player
+
+
+def test_leaderboard(ctrl):
+    zerg = add_ranked_player(ctrl, 1, 5000)
+    terran = add_ranked_player(ctrl, 2, 4000, race=Race.Terran)
+    korean = add_ranked_player(ctrl, 3, 6000, server=Server.Korea)
+    add_ranked_player(ctrl, 4, 0)
+
+    ctrl.update_leaderboard()
+
+    entries = ctrl.db_session.query(Leaderboard).order_by(
+        Leaderboard.rank).all()
+    assert [entry.player_id for entry in entries] == [
+        korean.id, zerg.id, terran.id]
+    assert [entry.server_rank for entry in entries] == [1, 1, 2]
+    assert [entry.race_rank for entry in entries] == [1, 2, 1]
+    assert entries[0].winrate == 0.75
+    assert entries[0].trend == 1.5
+
+    terran.mmr = 7000
+    ctrl.db_session.commit()
+    ctrl.update_leaderboard()
+    assert terran.leaderboard.mmr == 4000
+
+    ctrl.changed_players.add(terran.id)
+    ctrl.update_leaderboard()
+    assert terran.leaderboard.mmr == 7000
+    assert terran.leaderboard.rank == 1
+    assert terran.leaderboard.server_rank == 1
+    assert zerg.leaderboard.rank == 3
+    assert zerg.leaderboard.server_rank == 2
+    assert not ctrl.changed_players
+
+    ctrl.db_session.delete(terran)
+    ctrl.db_session.commit()
+    assert ctrl.db_session.query(Leaderboard).count() == 2
+    ctrl.update_leaderboard()
+    assert [zerg.leaderboard.rank, korean.leaderboard.rank] == [2, 1]
+
+
+def test_leaderboard_chunks(ctrl):
+    for player_id in range(1, 21):
+        add_ranked_player(ctrl, player_id, 3000 + player_id)
+    ctrl.db_session.expunge_all()
+    ctrl.player_chunk_size = 8
+    statements = []
+    event.listen(ctrl.db_session.get_bind(), 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    ctrl.update_leaderboard(full=True)
+    selects = [statement for statement in statements
+               if statement.startswith('SELECT')]
+    # Three chunks of players with their entries and statistics, the
+    # empty last chunk and the ranking.
+    assert len(selects) == 3 * 3 + 1 + 1
+    assert not any(isinstance(entry, Player)
+                   for entry in ctrl.db_session.identity_map.values())
+    assert ctrl.db_session.query(Leaderboard.rank).filter(
+        Leaderboard.player_id == 20).scalar() == 1
+
+
+def test_credential_keys(ctrl):
+    ctrl.setup(api_key_2='b', api_secret_2='2', api_key_10='j',
+               api_secret_12='l')
+    assert ctrl.get_config('api_key_10') == 'j'
+    for key in ('api_key_1', 'api_key_01', 'api_secret_'):
+        with pytest.raises(ValueError):
+            ctrl.setup(**{key: 'x'})
+
+
+def test_schema_version(tmp_path, monkeypatch):
+    db = f"sqlite:///{tmp_path / 'schema.db'}"
+    calls = []
+    create_all = model.Base.metadata.create_all
+    monkeypatch.setattr(model.Base.metadata, 'create_all',
+                        lambda engine: calls.append(engine)
+                        or create_all(engine))
+
+    model.create_db_session(db=db).close()
+    assert len(calls) == 1
+    model._checked_schemas.clear()
+    session = model.create_db_session(db=db)
+    assert len(calls) == 1
+    assert session.query(model.Config.value).filter(
+        model.Config.key == 'schema_version').scalar() == str(
+        model.SCHEMA_VERSION)
+    session.close()
+
+
+def test_lazy_import():
+    code = ('import sys, sc2monitor; '
+            'assert "aiohttp" not in sys.modules; '
+            'assert "sqlalchemy" not in sys.modules; '
+            'assert sc2monitor.Controller.__name__ == "Controller"')
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -1,7 +1,35 @@
 """Test the sc2monitor model."""
+from datetime import datetime
+
 import pytest
+from sqlalchemy import Column, MetaData, Table, create_engine, inspect
+from sqlalchemy.exc import OperationalError
+
+import sc2monitor.model as model
+from sc2monitor.model import (ENGINE_PROFILES, Config, League, Match, Player,
+                              Race, Result, Run, Server, create_db_session,
+                              create_report_session, insert_ignore,
+                              sqlite_pragmas)
+
+BASELINE_TABLES = ['config', 'season', 'player', 'match', 'statistics',
+                   'logs']
+BASELINE_RUN_COLUMNS = ['id', 'datetime', 'duration', 'api_requests',
+                        'api_retries', 'warnings', 'errors']
 
-from sc2monitor.model import League, Race, Result, Server
+
+def create_baseline_schema(db):
+    """Create the unversioned schema of databases before migrations."""
+    metadata = MetaData()
+    for name in BASELINE_TABLES:
+        model.Base.metadata.tables[name].to_metadata(metadata)
+    metadata.tables['match'].indexes.clear()
+    Table('runs', metadata, *[
+        Column(name, Run.__table__.c[name].type,
+               primary_key=Run.__table__.c[name].primary_key)
+        for name in BASELINE_RUN_COLUMNS])
+    engine = create_engine(db)
+    metadata.create_all(engine)
+    return engine, metadata
 
 
 def test_result_win():
@@ -145,3 +173,119 @@ def test_league():
         League.Master >= 5 == NotImplemented
     with pytest.raises(TypeError):
         League.Master <= 'Diamond' == NotImplemented
+
+
+def test_sqlite_profile(tmp_path):
+    db = f"sqlite:///{tmp_path / 'profile.db'}"
+    session = create_db_session(db, sqlite_profile={'cache_size': -1024})
+    pragma = session.connection().exec_driver_sql
+    assert pragma('PRAGMA journal_mode').scalar() == 'wal'
+    assert pragma('PRAGMA synchronous').scalar() == 1  # NORMAL
+    assert pragma('PRAGMA cache_size').scalar() == -1024
+    assert pragma('PRAGMA temp_store').scalar() == 2  # MEMORY
+    session.add(Config(key='writer', value='1'))
+    session.commit()
+
+    report = create_report_session(db, sqlite_profile=True)
+    assert report.query(Config.value).filter(
+        Config.key == 'writer').scalar() == '1'
+    report.add(Config(key='report', value='1'))
+    with pytest.raises(OperationalError):
+        report.commit()
+    report.rollback()
+    report.close()
+    session.close()
+
+    assert not sqlite_pragmas('sqlite://', True)
+    assert not sqlite_pragmas(db, None)
+
+
+def test_engine_profile(tmp_path):
+    db = f"sqlite:///{tmp_path / 'engine.db'}"
+    session = create_db_session(db, engine_profile={'pool_pre_ping': True,
+                                                    'pool_recycle': 60})
+    pool = session.get_bind().pool
+    assert pool._pre_ping
+    assert pool._recycle == 60
+    session.close()
+
+    assert ENGINE_PROFILES['mysql']['pool_pre_ping']
+    with pytest.raises(ValueError):
+        create_db_session(db, engine_profile='unknown')
+
+
+def test_match_key(tmp_path):
+    db = f"sqlite:///{tmp_path / 'match.db'}"
+    session = create_db_session(db)
+    player = Player(player_id=1)
+    session.add(player)
+    session.commit()
+    matches = [dict(player_id=player.id, result=Result.Win,
+                    datetime=datetime(2020, 1, 1, minute=minute))
+               for minute in range(3)]
+    statement = insert_ignore(Match.__table__, 'sqlite')
+    session.execute(statement, matches)
+    session.execute(statement, matches[1:] + matches[1:])
+    session.commit()
+    assert session.query(Match).count() == 3
+
+    # Simulate a database created before the natural key was added.
+    engine = session.get_bind()
+    session.close()
+    next(iter(Match.__table__.indexes)).drop(engine)
+    with engine.begin() as connection:
+        connection.execute(Match.__table__.insert(), matches[:2])
+        connection.execute(Config.__table__.update().where(
+            Config.key == 'schema_version').values(value='3'))
+    model._checked_schemas.clear()
+    engine.dispose()
+
+    session = create_db_session(db)
+    assert session.query(Match).count() == 3
+    indexes = inspect(session.get_bind()).get_indexes('match')
+    assert [index['unique'] for index in indexes
+            if index['name'] == 'ix_match_natural'] == [1]
+
+    # Simulate a database created before the schema version was stored.
+    engine = session.get_bind()
+    session.close()
+    next(iter(Match.__table__.indexes)).drop(engine)
+    with engine.begin() as connection:
+        connection.execute(Match.__table__.insert(), matches)
+        connection.execute(Config.__table__.delete().where(
+            Config.key == 'schema_version'))
+    model._checked_schemas.clear()
+    engine.dispose()
+
+    session = create_db_session(db)
+    assert session.query(Match).count() == 3
+    indexes = inspect(session.get_bind()).get_indexes('match')
+    assert [index['unique'] for index in indexes
+            if index['name'] == 'ix_match_natural'] == [1]
+    session.execute(statement, matches)
+    assert session.query(Match).count() == 3
+    session.close()
+
+
+def test_schema_upgrade(tmp_path):
+    db = f"sqlite:///{tmp_path / 'baseline.db'}"
+    engine, metadata = create_baseline_schema(db)
+    with engine.begin() as connection:
+        connection.execute(metadata.tables['runs'].insert().values(
+            id=1, duration=1.0))
+    engine.dispose()
+
+    session = create_db_session(db)
+    columns = {column['name'] for column in inspect(
+        session.get_bind()).get_columns('runs')}
+    assert columns == {column.name for column in Run.__table__.columns}
+    assert 'ix_match_natural' in {index['name'] for index in inspect(
+        session.get_bind()).get_indexes('match')}
+    run = session.query(Run).one()
+    assert run.duration == 1.0
+    assert run.coverage == 1.0
+    session.add(Run(finished=False))
+    session.commit()
+    assert session.query(Config.value).filter(
+        Config.key == 'schema_version').scalar() == str(model.SCHEMA_VERSION)
+    session.close()
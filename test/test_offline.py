@@ -0,0 +1,854 @@
+"""Test the sc2monitor against the offline fake api."""
+import asyncio
+import gc
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from fakeapi import FakeBlizzardAPI
+
+from sc2monitor.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from sc2monitor.controller import Controller
+from sc2monitor.limiter import ConcurrencyLimiter
+from sc2monitor.metrics import Metrics
+from sc2monitor.model import (CarriedPlayer, LadderMembership,
+                              Leaderboard, League, Log, Match, Player, Run,
+                              Season, Server)
+from sc2monitor.sc2api import InvalidApiResponse
+from sc2monitor.sqlstats import fingerprint
+
+
+@asynccontextmanager
+async def patched_controller(api, db='sqlite://', **kwargs):
+    """Yield a controller using the fake api with all its players."""
+    async with Controller(db=db, **kwargs) as ctrl:
+        api.patch(ctrl.sc2api)
+        for account in api.accounts.values():
+            ctrl.add_player(account.url())
+        yield ctrl
+
+
+@asynccontextmanager
+async def offline_controller(api_options, **kwargs):
+    """Yield a new fake api and a controller using it."""
+    async with FakeBlizzardAPI(**api_options) as api:
+        async with patched_controller(api, **kwargs) as ctrl:
+            yield api, ctrl
+
+
+async def offline_loop(api):
+    async with patched_controller(api) as ctrl:
+        await ctrl.run()
+
+        run = ctrl.db_session.query(Run).order_by(
+            Run.datetime.desc()).limit(1).scalar()
+        assert run is not None
+        assert run.errors == 0
+        assert run.api_requests == ctrl.sc2api.request_count
+
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.name == account.name
+            assert player.mmr == account.mmr
+            assert player.wins == account.wins
+            assert player.losses == account.losses
+
+        assert ctrl.db_session.query(Leaderboard).count() == len(api.accounts)
+
+        matches = ctrl.db_session.query(Match).count()
+        seasons = api.requests['season']
+        api.advance(activity=1.0)
+        new_games = sum(account.wins + account.losses
+                        for account in api.accounts.values()) - matches
+
+        requests = ctrl.sc2api.request_count
+        await ctrl.run()
+
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.api_requests == ctrl.sc2api.request_count - requests
+        # The stored seasons do not end soon and are used as they are.
+        assert api.requests['season'] == seasons
+        assert ctrl.db_session.query(Match).count() == matches + new_games
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.mmr == account.mmr
+            assert player.leaderboard.mmr == account.mmr
+
+        errors = ctrl.db_session.query(Log).filter(
+            Log.level == 'ERROR').count()
+        assert errors == 0
+
+        await ctrl.update_seasons(force=True)
+        assert api.requests['season'] == 2 * seasons
+
+
+async def fake_api_loop(**kwargs):
+    async with FakeBlizzardAPI(**kwargs) as api:
+        await offline_loop(api)
+        return api
+
+
+def test_offline_run(caplog):
+    caplog.set_level(logging.ERROR)
+
+    api = asyncio.run(fake_api_loop(players=20, ladder_size=8))
+
+    assert api.requests['token'] == 1
+    # The second run uses the ladders cached by the first.
+    assert api.requests['ladder_summary'] == 20
+
+    for record in caplog.records:
+        assert record.levelname != 'CRITICAL'
+        assert record.levelname != 'ERROR'
+
+
+async def record_replay_loop(tmp_path):
+    archive = str(tmp_path / 'responses.jsonl.gz')
+    async with offline_controller(dict(players=10, ladder_size=4),
+                                  record=archive) as (api, ctrl):
+        await ctrl.run()
+        recorded = {player.player_id: (player.mmr, player.wins)
+                    for player in ctrl.db_session.query(Player)}
+        requests = ctrl.sc2api.request_count
+        url = api.url
+
+    async with Controller(db='sqlite://', replay=archive,
+                          replay_speed=0.0) as ctrl:
+        ctrl.sc2api.api_url = url
+        ctrl.sc2api.oauth_url = url
+        for account in api.accounts.values():
+            ctrl.add_player(account.url())
+        await ctrl.run()
+        replayed = {player.player_id: (player.mmr, player.wins)
+                    for player in ctrl.db_session.query(Player)}
+        assert ctrl.sc2api.request_count == requests
+        assert ctrl.sc2api.transport.misses == 0
+
+    assert replayed == recorded
+
+
+def test_record_replay(tmp_path):
+    asyncio.run(record_replay_loop(tmp_path))
+
+
+async def access_token_loop(db):
+    async with FakeBlizzardAPI(players=2, ladder_size=2) as api:
+        async with patched_controller(api, db=db) as ctrl:
+            await ctrl.run()
+        assert api.requests['token'] == 1
+        assert api.requests['check_token'] == 0
+
+        async with patched_controller(api, db=db) as ctrl:
+            assert ctrl.sc2api.access_token_valid()
+            async with ctrl.sc2api.credentials[0].lock:
+                # A valid token is returned without waiting for the lock.
+                await asyncio.wait_for(ctrl.sc2api.get_access_token(), 1.0)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(ctrl.run_forever(0.01), 0.5)
+            assert ctrl.sc2api.credentials[0].refresh_task is not None
+            assert ctrl.db_session.query(Run).count() >= 2
+            # Tokens stored without expiry are checked once.
+            ctrl.set_config('access_token_expiry', '0')
+            ctrl.sc2api.credentials[0].access_token = ''
+            ctrl.sc2api.read_config()
+            await ctrl.sc2api.get_access_token()
+            await ctrl.sc2api.get_access_token()
+            assert int(ctrl.get_config('access_token_expiry')) > time.time()
+        assert api.requests['token'] == 1
+        assert api.requests['check_token'] == 1
+
+
+def test_access_token(tmp_path):
+    asyncio.run(access_token_loop(f"sqlite:///{tmp_path / 'token.db'}"))
+
+
+async def revoked_token_loop():
+    async with offline_controller(dict(players=10,
+                                       ladder_size=5)) as (api, ctrl):
+        await ctrl.run()
+        # The api rejects the stored token long before its expiry.
+        api.tokens.clear()
+        api.advance(activity=1.0)
+        await ctrl.run()
+        assert api.requests['token'] >= 2
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+
+
+def test_revoked_token():
+    asyncio.run(revoked_token_loop())
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('ladder@2', error_rate=0.5, window=4,
+                             cooldown=0.0)
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(False, probe=True)
+    assert breaker.state == OPEN
+    assert breaker.allow()
+    breaker.record(True, probe=True)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.abandon_probe()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+async def abandoned_probe_loop():
+    async with offline_controller(dict(players=2, ladder_size=2),
+                                  breaker_cooldown=0) as (api, ctrl):
+        sc2api = ctrl.sc2api
+        player = ctrl.db_session.query(Player).first()
+        await sc2api.get_metadata(player)
+        breaker, = sc2api.breakers.breakers.values()
+        breaker.record(False, probe=True)
+        assert breaker.state == OPEN
+
+        async def fail(credential=None):
+            raise InvalidApiResponse('oauth/token')
+
+        # Requests failing before they are made do not take the probe.
+        sc2api.get_access_token, get_access_token = (
+            fail, sc2api.get_access_token)
+        with pytest.raises(InvalidApiResponse):
+            await sc2api.get_metadata(player)
+        sc2api.get_access_token = get_access_token
+        # Neither do cancelled requests.
+        api.latency = 1.0
+        task = asyncio.create_task(sc2api._perform_request(
+            'GET', f'{sc2api.api_url}/sc2/metadata/profile/'
+            f'{player.server.id()}/{player.realm}/{player.player_id}',
+            authenticate=True))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        api.latency = 0.0
+        await sc2api.get_metadata(player)
+        assert breaker.state == CLOSED
+
+
+def test_abandoned_probe():
+    asyncio.run(abandoned_probe_loop())
+
+
+def test_metrics_reservoir():
+    metrics = Metrics()
+    metrics.reservoir_size = 100
+    for idx in range(1, 10001):
+        metrics.record('endpoint', 'ladder', idx / 10000)
+    summary = metrics.summary()[('endpoint', 'ladder')]
+    assert len(metrics.samples[('endpoint', 'ladder')].samples) == 100
+    assert summary['count'] == 10000
+    assert summary['total'] == pytest.approx(5000.5)
+    assert 0.35 < summary['p50'] < 0.65
+    assert summary['p95'] > 0.85
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(initial=4, min_limit=2, max_limit=10,
+                                 window=4)
+    # Slow start
+    for _ in range(4):
+        limiter.record(False, 0.1)
+    assert limiter.current == 8
+    assert limiter.record(True)
+    assert limiter.current == 4
+    # Only one decrease per round trip
+    assert not limiter.record(True)
+    assert limiter.current == 4
+    for _ in range(4):
+        limiter.record(False, 0.1)
+    assert limiter.current == 4
+    for _ in range(8):
+        limiter.record(False, 0.1)
+    assert limiter.current == 6
+    # Rising latency
+    assert limiter.record(False, 1.0)
+    assert limiter.current == 3
+    for _ in range(100):
+        limiter.record(False, 0.1)
+    assert limiter.current == 10
+
+
+async def adaptive_concurrency_loop():
+    async with offline_controller(
+            dict(players=60, latency=0.02, capacity=10),
+            concurrency_limit_max=100) as (api, ctrl):
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).one()
+        assert 4 <= run.concurrency_limit < 30
+        assert api.requests['throttled'] < run.api_requests / 4
+        assert ctrl.sc2api.limiter.in_flight == 0
+
+
+def test_adaptive_concurrency():
+    asyncio.run(adaptive_concurrency_loop())
+
+
+async def credential_pool_loop():
+    async with offline_controller(
+            dict(players=30, ladder_size=5), api_key='a', api_secret='1',
+            api_key_2='b', api_secret_2='2',
+            api_key_3='c', api_secret_3='3') as (api, ctrl):
+        assert len(ctrl.sc2api.credentials) == 3
+        await ctrl.run()
+        assert api.requests['token'] == 3
+        requests = [api.client_requests[client] for client in 'abc']
+        assert min(requests) > max(requests) / 2
+        run = ctrl.db_session.query(Run).one()
+        counts = {metric.name: metric.count for metric in run.metrics
+                  if metric.kind == 'credential'}
+        assert counts == {'1': requests[0], '2': requests[1],
+                          '3': requests[2]}
+
+        # Traffic moves to the other credentials.
+        api.throttled_clients.add('b')
+        api.client_requests.clear()
+        api.advance(activity=1.0)
+        await ctrl.run()
+        assert api.client_requests['b'] < api.client_requests['a'] / 2
+        assert api.client_requests['b'] == api.requests['throttled']
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+
+
+def test_credential_pool():
+    asyncio.run(credential_pool_loop())
+
+
+async def degraded_region_loop():
+    async with offline_controller(
+            dict(players=30, regions=(1, 2), ladder_size=5),
+            breaker_window=6, breaker_cooldown=60) as (api, ctrl):
+        await ctrl.run()
+
+        api.error_rate = 1.0
+        api.error_regions = {2}
+        api.advance(activity=1.0)
+        api.requests.clear()
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.deferred_players == 15
+        # Without the breaker every player would make 5 attempts,
+        # with it mostly the requests started before it opened fail.
+        assert api.requests['errors'] < 2 * 15
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            if account.region == 1:
+                assert player.wins == account.wins
+
+
+def test_degraded_region():
+    asyncio.run(degraded_region_loop())
+
+
+async def coalescing_loop():
+    async with offline_controller(
+            dict(players=2, ladder_size=2, latency=0.05)) as (api, ctrl):
+        player = ctrl.db_session.query(Player).first()
+        results = await asyncio.gather(
+            *[ctrl.sc2api.get_metadata(player) for _ in range(3)])
+        assert results[0] is results[1] is results[2]
+        assert api.requests['metadata'] == 1
+        assert ctrl.sc2api.coalesced_count == 2
+        assert not ctrl.sc2api._in_flight
+
+        await ctrl.sc2api.get_metadata(player)
+        assert api.requests['metadata'] == 2
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        # The requests above were coalesced before the run.
+        assert run.coalesced_requests == 0
+
+
+def test_request_coalescing():
+    asyncio.run(coalescing_loop())
+
+
+async def budget_loop():
+    async with offline_controller(dict(players=20, ladder_size=5),
+                                  fetch_concurrency=2) as (api, ctrl):
+        await ctrl.run()
+
+        api.latency = 0.05
+        api.advance(activity=1.0)
+        await ctrl.run(budget=0.5)
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.players_due == 20
+        assert 0 < run.players_processed < 20
+        carried = ctrl.db_session.query(CarriedPlayer).all()
+        assert len(carried) == 20 - run.players_processed
+
+        profiles = ctrl.prioritize()
+        assert len(profiles) == 20
+        assert ({profile.player_id for profile in profiles[:len(carried)]}
+                == {entry.player_id for entry in carried})
+
+        api.latency = 0.0
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.coverage == 1.0
+        assert ctrl.db_session.query(CarriedPlayer).count() == 0
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+
+
+def test_run_budget():
+    asyncio.run(budget_loop())
+
+
+async def resume_loop():
+    async with offline_controller(
+            dict(players=20, ladder_size=5, latency=0.05),
+            fetch_concurrency=2) as (api, ctrl):
+        # Interrupt the run as if the process died.
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(ctrl.run(), 0.5)
+        ctrl.db_session.rollback()
+        run = ctrl.db_session.query(Run).one()
+        assert not run.finished
+        completed = len(run.checkpoints)
+        assert 0 < completed < 20
+
+        api.requests.clear()
+        await ctrl.run()
+        assert ctrl.db_session.query(Run).one() is run
+        assert run.finished
+        assert run.players_processed == 20
+        assert run.checkpoints == []
+        # Requests still in flight from the interrupted run are shared.
+        assert api.requests['ladder_summary'] <= 20 - completed
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+
+        await ctrl.run()
+        assert ctrl.db_session.query(Run).count() == 2
+
+
+def test_resume_run():
+    asyncio.run(resume_loop())
+
+
+async def resume_leaderboard_loop():
+    async with offline_controller(
+            dict(players=20, ladder_size=5, latency=0.05),
+            fetch_concurrency=2, player_chunk_size=2) as (api, ctrl):
+        await ctrl.run()
+        api.advance(activity=1.0)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(ctrl.run(), 0.5)
+        ctrl.db_session.rollback()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert 0 < len(run.checkpoints) < 20
+
+        await ctrl.run()
+        assert run.finished
+        for player in ctrl.db_session.query(Player):
+            assert player.leaderboard.mmr == player.mmr
+            assert player.leaderboard.wins == player.wins
+
+
+def test_resume_leaderboard():
+    asyncio.run(resume_leaderboard_loop())
+
+
+async def chunked_loop():
+    async with offline_controller(dict(players=12, ladder_size=4),
+                                  player_chunk_size=3) as (api, ctrl):
+        await ctrl.run()
+        api.advance(activity=1.0)
+        await ctrl.run()
+        gc.collect()
+        # The processed players do not stay in the session.
+        assert len(ctrl.db_session.identity_map) < 12
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.players_processed == 12
+        assert run.peak_rss > 0
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+
+
+def test_chunked_players():
+    asyncio.run(chunked_loop())
+
+
+async def failed_stage_loop():
+    async with offline_controller(dict(players=12, ladder_size=4),
+                                  player_chunk_size=3) as (api, ctrl):
+        chunks = [0]
+
+        def load_ladder_cache(profiles):
+            chunks[0] += 1
+            if chunks[0] == 2:
+                raise RuntimeError('Lost connection')
+
+        ctrl.load_ladder_cache = load_ladder_cache
+        with pytest.raises(RuntimeError):
+            await ctrl.run()
+        await asyncio.sleep(0.1)
+        # The reconcile and persist stages stop instead of waiting.
+        assert not [task for task in asyncio.all_tasks()
+                    if '.<locals>.' in task.get_coro().__qualname__]
+
+
+def test_failed_stage():
+    asyncio.run(failed_stage_loop())
+
+
+async def failed_worker_loop():
+    async with offline_controller(dict(players=12, ladder_size=4),
+                                  pipeline_queue_size=1) as (api, ctrl):
+        checkpoint = ctrl.checkpoint
+        calls = [0]
+
+        def fail_checkpoint(player):
+            calls[0] += 1
+            if calls[0] == 2:
+                raise RuntimeError('Lost connection')
+            checkpoint(player)
+
+        ctrl.checkpoint = fail_checkpoint
+        with pytest.raises(RuntimeError):
+            await ctrl.run()
+        # The fetch and reconcile stages are cancelled with the workers.
+        assert not [task for task in asyncio.all_tasks()
+                    if '.<locals>.' in task.get_coro().__qualname__]
+
+
+def test_failed_worker():
+    asyncio.run(failed_worker_loop())
+
+
+async def failed_players_loop():
+    async with offline_controller(dict(players=2,
+                                       ladder_size=2)) as (api, ctrl):
+        async def fail(item):
+            item['player'].name = 'Broken'
+            raise RuntimeError('Persisting failed')
+
+        player = ctrl.db_session.query(Player).first()
+        assert not await ctrl.run_stage(fail, {'player': player})
+        # Failed players do not stay in the session.
+        assert player not in ctrl.db_session
+
+
+def test_failed_players():
+    asyncio.run(failed_players_loop())
+
+
+async def rollover_loop():
+    async with offline_controller(
+            dict(players=12, ladder_size=2)) as (api, ctrl):
+        await ctrl.run()
+
+        def count_matches(account):
+            return ctrl.db_session.query(Match).join(Player).filter(
+                Player.player_id == account.profile_id).count()
+
+        expected = {}
+        for account in api.accounts.values():
+            expected[account.profile_id] = (count_matches(account)
+                                            - account.wins
+                                            - account.losses)
+        # Games played after the last run of the ending season.
+        api.advance(activity=1.0)
+        for account in api.accounts.values():
+            expected[account.profile_id] += account.wins + account.losses
+        ctrl.db_session.query(Season).update(
+            {Season.end: datetime.now() - timedelta(hours=1)})
+        ctrl.db_session.commit()
+        api.new_season()
+        api.advance(activity=1.0)
+        api.requests.clear()
+
+        await ctrl.run()
+        assert api.requests['legacy_ladder'] == 6
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+            assert player.ladder_id == account.ladder_id
+            assert player.last_active_season == api.season_id
+            assert count_matches(account) == (
+                expected[account.profile_id]
+                + account.wins + account.losses)
+
+
+def test_season_rollover():
+    asyncio.run(rollover_loop())
+
+
+async def crawl_loop():
+    async with offline_controller(
+            dict(players=60, regions=(2,), ladder_size=10),
+            crawl_mode=1) as (api, ctrl):
+        await ctrl.run()
+        crawlable = ctrl.db_session.query(Player).filter(
+            Player.league.in_([League.Master,
+                               League.Grandmaster])).count()
+        master_ladders = ctrl.db_session.query(Player.ladder_id).filter(
+            Player.league == League.Master).distinct().count()
+
+        api.advance(activity=0.3)
+        api.requests.clear()
+        await ctrl.run()
+        assert api.requests['grandmaster_ladder'] == 1
+        # The other profiles use their cached ladders.
+        assert api.requests['ladder_summary'] == 0
+        assert api.requests['ladder'] == 60 - crawlable + master_ladders
+        assert api.requests['match_history'] < 60
+        for account in api.accounts.values():
+            player = ctrl.db_session.query(Player).filter(
+                Player.player_id == account.profile_id).scalar()
+            assert player.wins == account.wins
+            assert player.losses == account.losses
+
+
+def test_crawl_mode():
+    asyncio.run(crawl_loop())
+
+
+async def crawl_unknown_season_loop():
+    async with offline_controller(
+            dict(players=20, regions=(1, 2), ladder_size=5),
+            crawl_mode=1) as (api, ctrl):
+        await ctrl.run()
+        update_season = ctrl.update_season
+
+        async def fail_europe(server, force=False):
+            if server == Server.Europe:
+                raise InvalidApiResponse('season')
+            return await update_season(server, force=force)
+
+        ctrl.update_season = fail_europe
+        ctrl.season_ids.pop(Server.Europe.id())
+        api.advance(activity=1.0)
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        assert run.finished
+        assert ctrl.db_session.query(Log).filter(
+            Log.msg.like('%Europe were not crawled%')).count() == 1
+        for account in api.accounts.values():
+            if account.region == 1:
+                player = ctrl.db_session.query(Player).filter(
+                    Player.player_id == account.profile_id).scalar()
+                assert player.wins == account.wins
+
+
+def test_crawl_unknown_season():
+    asyncio.run(crawl_unknown_season_loop())
+
+
+async def ladder_cache_loop():
+    async with offline_controller(
+            dict(players=20, ladder_size=5)) as (api, ctrl):
+        await ctrl.run()
+        assert api.requests['ladder_summary'] == 20
+        assert ctrl.db_session.query(LadderMembership).count() == 20
+
+        api.advance(activity=1.0)
+        api.requests.clear()
+        await ctrl.run()
+        assert api.requests['ladder_summary'] == 0
+
+        # A player moved to another ladder is found via the summary.
+        account = next(iter(api.accounts.values()))
+        ladder_id = next(ladder_id for ladder_id in api.ladders
+                         if ladder_id != account.ladder_id)
+        api.ladders[account.ladder_id].remove(account)
+        api.ladders[ladder_id].append(account)
+        account.ladder_id = ladder_id
+        account.joined += 3600
+        api.advance(activity=1.0)
+        api.requests.clear()
+        await ctrl.run()
+        assert api.requests['ladder_summary'] == 1
+        player = ctrl.db_session.query(Player).filter(
+            Player.player_id == account.profile_id).scalar()
+        assert player.ladder_id == ladder_id
+        assert player.wins == account.wins
+        entry = ctrl.db_session.query(LadderMembership).filter(
+            LadderMembership.player_id == account.profile_id).one()
+        assert entry.ladders == {ladder_id}
+
+        # Cached ladders showing fewer games than stored are requested
+        # again before the player is reconciled.
+        account = list(api.accounts.values())[1]
+        ladder_id = next(ladder_id for ladder_id in api.ladders
+                         if ladder_id != account.ladder_id)
+        api.ladders[ladder_id].append(account)
+        account.ladder_id = ladder_id
+        player = ctrl.db_session.query(Player).filter(
+            Player.player_id == account.profile_id).scalar()
+        player.wins = account.wins + 2
+        ctrl.db_session.commit()
+        api.requests.clear()
+        await ctrl.run()
+        assert api.requests['ladder_summary'] == 1
+        entry = ctrl.db_session.query(LadderMembership).filter(
+            LadderMembership.player_id == account.profile_id).one()
+        assert entry.ladders == {ladder_id}
+
+        # Expired entries are requested again.
+        ctrl.db_session.query(LadderMembership).update(
+            {LadderMembership.updated: datetime.now() - timedelta(
+                days=2)})
+        ctrl.db_session.commit()
+        api.requests.clear()
+        await ctrl.run()
+        assert api.requests['ladder_summary'] == 20
+
+
+def test_ladder_cache():
+    asyncio.run(ladder_cache_loop())
+
+
+async def metrics_loop(api, collect_metrics):
+    async with patched_controller(api,
+                                  collect_metrics=collect_metrics) as ctrl:
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.datetime.desc()).limit(1).scalar()
+        metrics = {(metric.kind, metric.name): metric
+                   for metric in run.metrics}
+        ctrl.db_session.expunge_all()
+        return metrics, ctrl.sc2api.request_count
+
+
+async def fake_metrics_loop(collect_metrics):
+    async with FakeBlizzardAPI(players=6, ladder_size=3) as api:
+        return await metrics_loop(api, collect_metrics)
+
+
+def test_run_metrics():
+    metrics, requests = asyncio.run(fake_metrics_loop(1))
+    assert metrics[('phase', 'update_seasons')].count == 1
+    assert metrics[('phase', 'get_ladders')].count == 6
+    assert metrics[('phase', 'calc_statistics')].count == 6
+    assert metrics[('endpoint', 'ladder_summary')].count == 6
+    assert metrics[('endpoint', 'match_history')].count == 6
+    assert sum(metric.count for metric in metrics.values()
+               if metric.kind == 'endpoint') == requests
+    endpoint = metrics[('endpoint', 'ladder')]
+    assert 0.0 < endpoint.p50 <= endpoint.p95 <= endpoint.p99
+    assert endpoint.total >= endpoint.p99
+    assert metrics[('http', 'ttfb:ladder')].count == 6
+    assert metrics[('db', 'checkout')].count > 0
+    assert metrics[('http', 'decode:ladder')].count == 6
+    assert metrics[('http', 'ttfb:127.0.0.1')].count == requests
+    assert (metrics[('http', 'connect:127.0.0.1')].count
+            + metrics[('http', 'reuse:127.0.0.1')].count) == requests
+
+    metrics, requests = asyncio.run(fake_metrics_loop(0))
+    assert metrics == {}
+
+
+async def sql_stats_loop():
+    async with offline_controller(dict(players=6, ladder_size=3),
+                                  sql_n_plus_one_threshold=2) as (api, ctrl):
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.datetime.desc()).limit(1).scalar()
+        assert run.sql_statements > 0
+        assert run.sql_time > 0.0
+        assert 0 < len(run.statements) <= 20
+        assert any(statement.n_plus_one for statement in run.statements)
+        for statement in run.statements:
+            assert statement.count > 0
+            assert "'" not in statement.fingerprint
+        assert not ctrl.sql_stats.players
+
+
+def test_sql_stats():
+    assert fingerprint(
+        "SELECT * FROM player WHERE id IN (1, 2, 3) AND name = 'x'\n"
+        "  LIMIT ? OFFSET ?") == (
+        'SELECT * FROM player WHERE id IN (?) AND name = ? LIMIT ? OFFSET ?')
+    asyncio.run(sql_stats_loop())
+
+
+async def profile_loop():
+    # The latency makes the run last longer than the lag sampling interval.
+    async with offline_controller(
+            dict(players=6, ladder_size=3, latency=0.05),
+            profile_top=5) as (api, ctrl):
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.datetime.desc()).limit(1).scalar()
+        assert run.profile == []
+
+        await ctrl.run(profile=True)
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        kinds = [entry.kind for entry in run.profile]
+        assert kinds.count('function') == 5
+        assert 0 < kinds.count('allocation') <= 5
+        assert kinds.count('memory') == 1
+        for entry in run.profile:
+            if entry.kind == 'function':
+                assert entry.count > 0
+                assert entry.cumulative >= entry.total
+        assert any(metric.kind == 'event_loop'
+                   for metric in run.metrics)
+
+
+def test_profile():
+    asyncio.run(profile_loop())
+
+
+async def trace_loop(trace_dir):
+    async with offline_controller(dict(players=6, ladder_size=3),
+                                  trace_dir=trace_dir) as (api, ctrl):
+        await ctrl.run()
+        run = ctrl.db_session.query(Run).order_by(
+            Run.id.desc()).limit(1).scalar()
+        players = {player.id for player in ctrl.db_session.query(Player)}
+        return run.id, players
+
+
+def test_trace(tmp_path):
+    run_id, players = asyncio.run(trace_loop(str(tmp_path)))
+    with open(tmp_path / f'run-{run_id}.trace.json') as file:
+        trace = json.load(file)
+    spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    names = {event['name'] for event in spans}
+    assert {'get_ladders', 'get_ladder_data', 'check_match_history',
+            'process_player', 'calc_statistics', 'commit',
+            'ladder_summary'} <= names
+    assert {event['tid'] for event in spans} == players | {0}
+    for event in spans:
+        assert event['dur'] >= 0.0